@@ -0,0 +1,256 @@
+"""Compares the detection modes on recorded clips,
+   or runs the benchmark suite on synthetic boards and saves the results to compare them across commits.
+   usage: py benchmark.py CLIP [CLIP ...] [--frames N]
+          py benchmark.py --synthetic [--repeats N] [--save RESULTS.json] [--compare OLD_RESULTS.json]
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import cv2
+import cv2.aruco as aruco
+from detectors import RoiDetector, PyramidDetector, AdaptiveDetector, FrameGovernor
+from scheduler import Scheduler
+from synthetic import generate_board
+
+MAX_FRAMES = 300
+PYRAMID_SCALE = 0.5
+REPEATS = 20 # detections per synthetic frame and mode
+RESULTS_DIR = "benchmark_results"
+
+# synthetic boards: arguments for synthetic.generate_board
+SCENARIOS = {
+    "720p_10": dict(resolution=(1280, 720), marker_count=10),
+    "1080p_10": dict(resolution=(1920, 1080), marker_count=10),
+    "1080p_60": dict(resolution=(1920, 1080), marker_count=60),
+    "1080p_60_small": dict(resolution=(1920, 1080), marker_count=60, marker_px=32),
+    "1080p_10_blur": dict(resolution=(1920, 1080), marker_count=10, blur=5),
+    "1080p_10_noise": dict(resolution=(1920, 1080), marker_count=10, noise=8),
+    "1080p_10_warp": dict(resolution=(1920, 1080), marker_count=10, warp=0.02),
+}
+
+
+def load_clip(path, max_frames=MAX_FRAMES):
+    """Decodes the clip up front, so decoding doesn't count towards the detection time"""
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    cap.release()
+    return frames
+
+
+def run_full(frames, detector):
+    results = []
+    for gray in frames:
+        corners, ids, rejected = detector.detectMarkers(gray)
+        results.append(ids)
+    return results
+
+
+def run_roi(frames, detector):
+    roi_detector = RoiDetector(detector)
+    results = []
+    for gray in frames:
+        corners, ids = roi_detector.detect(gray)
+        results.append(ids)
+    return results
+
+
+def run_pyramid(frames, detector):
+    return run_full(frames, PyramidDetector(detector, scale=PYRAMID_SCALE))
+
+
+def run_adaptive(frames, detector):
+    return run_full(frames, AdaptiveDetector(aruco.getPredefinedDictionary(aruco.DICT_4X4_100)))
+
+
+def run_governed(frames, detector):
+    adaptive = AdaptiveDetector(aruco.getPredefinedDictionary(aruco.DICT_4X4_100))
+    governor = FrameGovernor(lambda gray: adaptive.detectMarkers(gray)[:2])
+    results = []
+    for gray in frames:
+        corners, ids = governor.detect(gray)
+        results.append(ids)
+    return results
+
+
+def same_ids(a, b):
+    a = set() if a is None else set(a.flatten())
+    b = set() if b is None else set(b.flatten())
+    return a == b
+
+
+# adaptive: parameters tuned to the marker size, governed: adaptive + frame-rate governor
+CLIP_MODES = [("full", run_full), ("roi", run_roi), ("pyramid", run_pyramid), ("adaptive", run_adaptive), ("governed", run_governed)]
+
+
+def benchmark_clip(path, max_frames=MAX_FRAMES):
+    frames = load_clip(path, max_frames)
+    if not frames:
+        print(f"{path}: no frames")
+        return
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
+    detector = aruco.ArucoDetector(dictionary, aruco.DetectorParameters())
+
+    timings = {}
+    results = {}
+    for name, run in CLIP_MODES:
+        start = time.perf_counter()
+        results[name] = run(frames, detector)
+        timings[name] = (time.perf_counter() - start) / len(frames) * 1000
+
+    h, w = frames[0].shape
+    print(f"{path} ({len(frames)} frames, {w}x{h})")
+    print(f"  full:     {timings['full']:.2f} ms/frame")
+    for name, run in CLIP_MODES[1:]:
+        agreement = sum(same_ids(a, b) for a, b in zip(results["full"], results[name])) / len(frames)
+        print(f"  {name + ':':9} {timings[name]:.2f} ms/frame  (x{timings['full'] / timings[name]:.1f}, same ids in {agreement:.0%} of frames)")
+
+
+def note_detector():
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
+    return aruco.ArucoDetector(dictionary, aruco.DetectorParameters())
+
+
+def detection_throughput(gray, repeats=REPEATS):
+    """ms per frame of every detection mode (the roi mode profits from the static frame, like a static board)"""
+    detector = note_detector()
+    frames = [gray] * repeats
+    timings = {}
+    for name, run in [("full", run_full), ("roi", run_roi), ("pyramid", run_pyramid)]:
+        start = time.perf_counter()
+        run(frames, detector)
+        timings[name] = (time.perf_counter() - start) / repeats * 1000
+    return timings
+
+
+def cell_accuracy(board):
+    """Runs the detected markers through Coordinator and Player.position_to_note and compares the notes with the ground truth"""
+    import coordinator # only needed here, takes a moment to import
+    from coordinator import lego, coord, player
+
+    frame = board.frame.copy()
+    corners, ids, rejected = note_detector().detectMarkers(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    # use the known cell size, so only the assignment of the markers gets measured
+    lego.marker_size = board.marker_px
+    lego.width_px, lego.height_px = board.cell_size
+    h, w = frame.shape[:2]
+    coord.frame_size = (h, w)
+    coord.rows, coord.cols = (h//lego.height_px, w//lego.width_px)
+    if ids is None:
+        coord.set_markers((), ())
+    else:
+        coord.set_markers(coord.get_marker_center(corners, frame), ids)
+
+    played = set()
+    snapshot = coord.snapshot
+    for column in snapshot.columns:
+        cells = snapshot.cells_in_column(column)
+        notes = player.cells_to_notes(cells)
+        played.update((column, int(pitch), int(id)) for pitch, id in zip(notes["pitch"], cells["id"]))
+    expected = {(int(t["x_idx"]), coordinator.REFERENCE_NOTE + coord.cols - int(t["y_idx"]), int(t["id"])) for t in board.truth}
+    return {
+        "recall": len(played & expected) / max(len(expected), 1),
+        "false_notes": len(played - expected),
+    }
+
+
+def scheduler_jitter(interval=0.05, duration=2.0, notes_per_beat=10):
+    """Runs a beat with a few note-offs per beat and returns the lateness/jitter of the scheduler"""
+    scheduler = Scheduler()
+    scheduler.start()
+    def beat():
+        for i in range(notes_per_beat):
+            scheduler.call_later(interval * 0.9, lambda: None)
+    timer = scheduler.every(interval, beat)
+    time.sleep(duration)
+    timer.cancel()
+    stats = scheduler.stats()
+    scheduler.stop()
+    return stats
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_suite(repeats=REPEATS):
+    results = {"commit": current_commit(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "detection_ms": {}, "accuracy": {}}
+    for name, scenario in SCENARIOS.items():
+        board = generate_board(**scenario)
+        gray = cv2.cvtColor(board.frame, cv2.COLOR_BGR2GRAY)
+        results["detection_ms"][name] = detection_throughput(gray, repeats)
+        results["accuracy"][name] = cell_accuracy(board)
+        timings = ", ".join(f"{mode} {ms:.2f} ms" for mode, ms in results["detection_ms"][name].items())
+        accuracy = results["accuracy"][name]
+        print(f"{name}: {timings} | recall {accuracy['recall']:.0%}, false notes {accuracy['false_notes']}")
+    results["scheduler"] = scheduler_jitter()
+    print("scheduler:", ", ".join(f"{k} {v:.3f}" for k, v in results["scheduler"].items()))
+    return results
+
+
+def flatten(results, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1} (only numbers)"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    old, new = flatten(old), flatten(new)
+    print(f"{'':40} {'old':>10} {'new':>10}")
+    for key in new:
+        if key not in old:
+            continue
+        change = f"{(new[key] - old[key]) / old[key]:+.0%}" if old[key] else ""
+        print(f"{key:40} {old[key]:10.3f} {new[key]:10.3f} {change:>6}")
+
+
+def run_synthetic(args):
+    options = {"--repeats": REPEATS, "--save": None, "--compare": None}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            options[name] = args[i + 1]
+    results = run_suite(int(options["--repeats"]))
+    path = options["--save"] or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("saved results to", path)
+    if options["--compare"]:
+        with open(options["--compare"]) as f:
+            compare(json.load(f), results)
+
+
+def run_clips(args):
+    max_frames = MAX_FRAMES
+    if "--frames" in args:
+        i = args.index("--frames")
+        max_frames = int(args[i + 1])
+        del args[i:i + 2]
+    if not args:
+        print(__doc__)
+    for clip in args:
+        benchmark_clip(clip, max_frames)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--synthetic" in args:
+        run_synthetic(args)
+    else:
+        run_clips(args)
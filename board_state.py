@@ -0,0 +1,45 @@
+from types import MappingProxyType
+import numpy as np
+from geometry import MARKER_CELL_DTYPE
+
+
+class BoardSnapshot:
+    """An immutable state of the board: the markers, the grid and the markers sorted into the columns of the timeline.
+       The vision side builds a new snapshot per detection result and publishes it by swapping one reference
+       (Coordinator.snapshot). The playback side reads that reference once and gets a consistent state without locks.
+    """
+    __slots__ = ("centers", "ids", "cells", "columns", "cell_width", "cell_height", "frame_size", "frame_time", "version")
+
+    def __init__(self, centers, ids, cells=(), cell_width=0, cell_height=0, frame_size=(0, 0), frame_time=None, version=0):
+        centers = np.array(centers, dtype=np.int32).reshape(-1, 2)
+        ids = np.array(ids, dtype=np.int32).reshape(-1, 1)
+        # cells (MARKER_CELL_DTYPE) sorted by the column of the timeline, in detection order within a column
+        cells = np.array(cells, dtype=MARKER_CELL_DTYPE).reshape(-1) if len(cells) else np.empty(0, dtype=MARKER_CELL_DTYPE)
+        cells = cells[np.argsort(cells["row"], kind="stable")]
+        rows, starts, counts = np.unique(cells["row"], return_index=True, return_counts=True)
+        for array in (centers, ids, cells):
+            array.flags.writeable = False
+        values = {
+            "centers": centers,
+            "ids": ids,
+            "cells": cells,
+            # column of the timeline -> slice of its cells
+            "columns": MappingProxyType({int(r): slice(s, s + c) for r, s, c in zip(rows, starts, counts)}),
+            "cell_width": cell_width,
+            "cell_height": cell_height,
+            "frame_size": tuple(frame_size), # (height, width)
+            "frame_time": frame_time, # capture time of the frame the markers are from
+            "version": version,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BoardSnapshot is immutable, publish a new one instead")
+
+    def cells_in_column(self, column):
+        """The cells of the markers in the column (a read-only view of `cells`)"""
+        return self.cells[self.columns.get(column, slice(0, 0))]
+
+
+EMPTY_BOARD = BoardSnapshot((), ())
@@ -0,0 +1,68 @@
+"""Saves and loads what a session measures before it can play: the marker and cell size, the homography of the
+   playfield and the camera settings (a calibration), optionally together with the markers on the board (a layout).
+   Both are compressed numpy files (.npz), so a restart can begin playing right away.
+"""
+import os
+import numpy as np
+
+FORMAT_VERSION = 1
+CAMERA_PREFIX = "camera_" # camera settings are stored as camera_<name>
+
+
+class Calibration:
+    """Sizes in pixels, `frame_size` as (height, width), `markers` as (N, 3) rows of (id, x, y) for a layout"""
+    def __init__(self, marker_size=0, cell_size=(0, 0), frame_size=(0, 0), homography=None, camera=None, markers=None):
+        self.marker_size = int(marker_size)
+        self.cell_size = tuple(int(v) for v in cell_size) # (width, height)
+        self.frame_size = tuple(int(v) for v in frame_size)
+        self.homography = None if homography is None else np.asarray(homography, dtype=np.float64)
+        self.camera = dict(camera or {}) # name -> value, see: CameraSource.settings()
+        self.markers = None if markers is None else np.asarray(markers, dtype=np.int32).reshape(-1, 3)
+
+    @property
+    def has_sizes(self):
+        """False if nothing was measured yet (all sizes 0)"""
+        return self.marker_size > 0 and min(self.cell_size) > 0
+
+    @property
+    def is_layout(self):
+        return self.markers is not None
+
+    def save(self, path):
+        """Writes the file, values that are unknown here (sizes, homography, camera) are kept from an existing file"""
+        if os.path.exists(path):
+            old = Calibration.load(path)
+            if not self.has_sizes:
+                self.marker_size, self.cell_size = old.marker_size, old.cell_size
+            if min(self.frame_size) == 0:
+                self.frame_size = old.frame_size
+            if self.homography is None:
+                self.homography = old.homography
+            self.camera = {**old.camera, **self.camera}
+        fields = {
+            "version": FORMAT_VERSION,
+            "marker_size": self.marker_size,
+            "cell_size": np.array(self.cell_size, dtype=np.int32),
+            "frame_size": np.array(self.frame_size, dtype=np.int32),
+        }
+        if self.homography is not None:
+            fields["homography"] = self.homography
+        if self.markers is not None:
+            fields["markers"] = self.markers
+        fields.update({CAMERA_PREFIX + name: np.float64(value) for name, value in self.camera.items()})
+        with open(path, "wb") as f: # np.savez would add .npz to other file names
+            np.savez_compressed(f, **fields)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) > FORMAT_VERSION:
+                raise ValueError(f"{path} was saved by a newer version (format {int(data['version'])})")
+            return cls(
+                marker_size=int(data["marker_size"]),
+                cell_size=data["cell_size"],
+                frame_size=data["frame_size"],
+                homography=data["homography"] if "homography" in data else None,
+                camera={key[len(CAMERA_PREFIX):]: float(data[key]) for key in data.files if key.startswith(CAMERA_PREFIX)},
+                markers=data["markers"] if "markers" in data else None,
+            )
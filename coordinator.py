@@ -1,12 +1,41 @@
 import threading
+import time
+LAUNCH_TIME = time.perf_counter() # before the slow imports, for the startup times of --dry-run
+import argparse
 import cv2
 import numpy as np
 import cv2.aruco as aruco
 import sys
 import math
-from sound_generation import Note, Instrument, SoundGenerator
-
-DEBUG = False # set to true, to see grid -> otherwise wont draw for better performance
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from sound_generation import Note, NOTE_DTYPE, Instrument, SoundGenerator, SynthWorker, NullSink, PortSink
+from pipeline import Pipeline
+from frame_source import open_source, CameraSource
+from scheduler import Scheduler
+from profiling import Profiler
+from geometry import marker_centers, marker_cells
+from tracking import MarkerTracker
+from board_state import BoardSnapshot, EMPTY_BOARD
+from detectors import RoiDetector, PyramidDetector, AdaptiveDetector, FrameGovernor
+from overlay import CachedOverlay
+from calibration import Calibration
+from lookahead import Lookahead
+
+DEBUG = False # set to true, to see the grid (it is only drawn once per grid size, see: CachedOverlay)
+DETECTION_WORKERS = 2 # number of threads detecting markers in parallel
+DETECTION_MODE = "full" # "full": search the whole frame, "roi": only search around the last known markers
+FULL_SCAN_EVERY = 30 # in "roi" mode: search the whole frame every n frames to find new markers
+PYRAMID_SCALE = 1.0 # < 1: detect on a downscaled frame and refine the corners in full resolution
+ADAPTIVE_DETECTION = False # tune the detector parameters to the marker size and how reliably the markers are found
+GOVERNOR_MAX_EVERY = 1 # > 1: detect only every 2nd, 4th, ... up to every nth frame while the board doesn't move
+SHOW_PROFILE = False # show the timings of all stages in the frame (toggle with p)
+PROFILE_FILE = "profile.json" # the timings get saved here on exit (None: don't save)
+TRACK_MAX_MISSED = 5 # a marker is kept for this many detections without it, so it doesn't flicker
+TRACK_SMOOTHING = 0.5 # smoothing of the marker positions (0: no smoothing)
+LOOKAHEAD_COLUMNS = 4 # notes of this many columns are built before the timeline gets there (0: at the beat)
+DRY_RUN_TIMEOUT = 30.0 # --dry-run gives up waiting for the first note after this many seconds
 
 NOTE_DURATION_IN_SEC = 0.5
 NOTE_VOLUME = 100
@@ -21,6 +50,10 @@ ID_TO_INSTRUMENT = {
     2: Instrument.SAX, # blue
     3: Instrument.WOODBLOCK, # yellow
 }
+# ID_TO_INSTRUMENT as a lookup table for the note batches (-1: no instrument)
+ID_TO_PROGRAM = np.full(max(ID_TO_INSTRUMENT) + 1, -1, dtype=np.int16)
+for id, instrument in ID_TO_INSTRUMENT.items():
+    ID_TO_PROGRAM[id] = instrument.value
 
 MIDI_INDEX_TO_NOTE = {
     0:"C",
@@ -37,34 +70,7 @@ MIDI_INDEX_TO_NOTE = {
     11:"B"
 }
 
-flip_image= False
-# INIT VIDEO FEED
-cam_id = 0
-if len(sys.argv) > 1:
-    cam_id = int(sys.argv[1])
-if len(sys.argv) > 2:
-    if sys.argv[2] in ["-f", "-F", "-flip", "flip"]:
-        flip_image = True
-    else:
-        bpm = float(sys.argv[2])
-        NOTE_DURATION_IN_SEC = 60 / bpm
-if len(sys.argv) > 3:
-    if flip_image:
-        bpm = float(sys.argv[3])
-        NOTE_DURATION_IN_SEC = 60 / bpm
-    else:
-        REFERENCE_NOTE = int(sys.argv[3])
-if len(sys.argv) > 4 and flip_image:
-    REFERENCE_NOTE = int(sys.argv[4])
-
-    
-
-aruco_dict_border = aruco.getPredefinedDictionary(aruco.DICT_6X6_100)
-aruco_dict_notes = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
-
-aruco_params = aruco.DetectorParameters()
-detector_border = aruco.ArucoDetector(aruco_dict_border,aruco_params)
-detector_notes = aruco.ArucoDetector(aruco_dict_notes, aruco_params)
+aruco_dict_notes = aruco.getPredefinedDictionary(aruco.DICT_4X4_100) # the detectors get created by make_note_detector()
 
 
 # ----- Helper classes ----- #
@@ -78,6 +84,8 @@ class Lego:
         self.height_mm = 31 + padding_h 
         self.marker_mm = 16
         self.marker_size = 0
+        self.width_px = 0
+        self.height_px = 0
         self.padding = 0 # add padding if you want -> best if it corresponds to the physical playfield (if used)
 
     def set_lego_size(self, corners, frame):
@@ -137,9 +145,18 @@ class Coordinator:
     def __init__(self):
         self.rows = 0
         self.cols = 0
-        self.centers = []
-        self.ids = []
+        self.snapshot = EMPTY_BOARD # replaced (never changed) on every detection result, see: set_markers()
+        self.frame_size = (0, 0) # (height, width)
         self.has_started = False
+        self.grid_overlay = CachedOverlay(self.draw_grid_layer)
+
+    @property
+    def centers(self):
+        return self.snapshot.centers
+
+    @property
+    def ids(self):
+        return self.snapshot.ids
 
     def draw_grid(self, frame):
         """see: https://stackoverflow.com/a/37705365"""
@@ -154,56 +171,119 @@ class Coordinator:
         rows, cols = (h//lego.height_px, w//lego.width_px)
 
         if DEBUG:
-            grid_x_idx = 0
-            grid_y_idx = 0
-
-            cell_width = lego.width_px
-            cell_height = lego.height_px
-
-            for x in range (0, w, cell_width):
-                x = int(x)
-                cv2.line(frame, (x, 0), (x, h), color=GRID_COLOR, thickness=1)
-                cv2.putText(frame, str(grid_x_idx), (x, h), cv2.FONT_HERSHEY_PLAIN, 1, GRID_COLOR)
-                grid_x_idx += 1
-
-            for y in range (0, h, cell_height):
-                y = int(y)
-                cv2.line(frame, (0, y), (w, y), color=GRID_COLOR, thickness=1)
-                note_name  = MIDI_INDEX_TO_NOTE[(REFERENCE_NOTE + grid_y_idx) % 12]
-                octave = math.floor((REFERENCE_NOTE + grid_y_idx) / 12) - 2
-                cv2.putText(frame, note_name + str(octave), (0, y+12), cv2.FONT_HERSHEY_PLAIN, 1, GRID_COLOR)
-                grid_y_idx += 1
+            # the grid only changes with its geometry, so it gets drawn once and pasted onto every frame
+            self.grid_overlay.apply(frame, (rows, cols, lego.width_px, lego.height_px, REFERENCE_NOTE))
 
         self.rows = rows
         self.cols = cols
+        self.frame_size = (h, w)
         self.has_started = True
 
+    def draw_grid_layer(self, layer):
+        """Draws the grid lines and labels onto the (BGRA) layer of the grid_overlay"""
+        h, w, _ = layer.shape
+        color = GRID_COLOR + (255,)
+        grid_x_idx = 0
+        grid_y_idx = 0
+
+        cell_width = lego.width_px
+        cell_height = lego.height_px
+
+        for x in range (0, w, cell_width):
+            x = int(x)
+            cv2.line(layer, (x, 0), (x, h), color=color, thickness=1)
+            cv2.putText(layer, str(grid_x_idx), (x, h), cv2.FONT_HERSHEY_PLAIN, 1, color)
+            grid_x_idx += 1
+
+        for y in range (0, h, cell_height):
+            y = int(y)
+            cv2.line(layer, (0, y), (w, y), color=color, thickness=1)
+            note_name  = MIDI_INDEX_TO_NOTE[(REFERENCE_NOTE + grid_y_idx) % 12]
+            octave = math.floor((REFERENCE_NOTE + grid_y_idx) / 12) - 2
+            cv2.putText(layer, note_name + str(octave), (0, y+12), cv2.FONT_HERSHEY_PLAIN, 1, color)
+            grid_y_idx += 1
+
 
     def get_marker_center(self, corners, frame):
         """Get the middle of the marker for all markers, see: https://stackoverflow.com/a/64742091"""
-        self.centers = [] # override
+        centers = marker_centers(corners)
 
-        for c in corners:
-            x_sum = c[0][0][0]+ c[0][1][0]+ c[0][2][0]+ c[0][3][0]
-            y_sum = c[0][0][1]+ c[0][1][1]+ c[0][2][1]+ c[0][3][1]
-                
-            x_centerPixel = int(x_sum*.25)
-            y_centerPixel = int(y_sum*.25)
+        for x_centerPixel, y_centerPixel in centers:
+            cv2.circle(frame, (int(x_centerPixel), int(y_centerPixel)), 5, (0, 0, 255), -1)
+        return centers
 
-            cv2.circle(frame, (x_centerPixel, y_centerPixel), 5, (0, 0, 255), -1)
+    def set_markers(self, centers, ids, frame_time=None):
+        """Publishes a new snapshot of the board with the (tracked) markers of a detection result.
+           The markers get sorted into the columns of the timeline, so the player only has to look up its current column.
+        """
+        cells = ()
+        if self.cols != 0 and len(ids) == len(centers):
+            cells = marker_cells(centers, ids, lego.width_px, lego.height_px, reverse_cols=self.cols)
+
+        snapshot = BoardSnapshot(centers, ids, cells, lego.width_px, lego.height_px,
+                                 self.frame_size, frame_time, self.snapshot.version + 1)
+        self.snapshot = snapshot # swapping the reference is all the player ever sees
+        player.prepare(snapshot)
+
+    def draw_markers(self, frame):
+        for x_centerPixel, y_centerPixel in self.snapshot.centers:
+            cv2.circle(frame, (int(x_centerPixel), int(y_centerPixel)), 5, (0, 0, 255), -1)
+
+    def calibration(self, camera=None, with_markers=False):
+        """The current calibration, with the markers on the board for a layout (see: calibration.py)"""
+        board = self.snapshot
+        markers = np.column_stack([board.ids.ravel(), board.centers]) if with_markers else None
+        return Calibration(lego.marker_size, (lego.width_px, lego.height_px), self.frame_size, camera=camera, markers=markers)
+
+    def apply_calibration(self, calibration:Calibration):
+        """Uses the saved sizes instead of measuring them, so playing can start right away"""
+        if not calibration.has_sizes:
+            return # saved before anything was measured (e.g. only the homography of detection.py), measure as usual
+        lego.marker_size = calibration.marker_size
+        lego.width_px, lego.height_px = calibration.cell_size
+        self.frame_size = calibration.frame_size
+        h, w = self.frame_size
+        self.rows, self.cols = (h//lego.height_px, w//lego.width_px)
+        self.has_started = True
 
-            self.centers.append((x_centerPixel, y_centerPixel)) # save centers
-        
+    def save_calibration(self, path, camera=None):
+        if lego.marker_size == 0:
+            print("nothing measured yet: press enter and put a marker below the camera first")
+            return
+        self.calibration(camera).save(path)
+        print("saved calibration to", path)
+
+    def save_layout(self, path, camera=None):
+        """Saves the current board (grid and markers), so it can be played without a camera (see: render_midi.py)"""
+        if lego.marker_size == 0:
+            print("nothing measured yet: press enter and put a marker below the camera first")
+            return
+        self.calibration(camera, with_markers=True).save(path)
+        print("saved layout to", path)
+
+    def load_layout(self, path) -> Calibration:
+        """Loads a layout (.npz, or .json from older versions) and plays its markers"""
+        if path.endswith(".json"):
+            with open(path) as f:
+                layout = json.load(f)
+            layout = Calibration(layout["marker_size"], layout["cell_size"], layout["frame_size"], markers=layout["markers"])
+        else:
+            layout = Calibration.load(path)
+        if not layout.is_layout:
+            raise ValueError(f"{path} is a calibration without markers, not a layout")
+        self.apply_calibration(layout)
+        self.set_markers(layout.markers[:, 1:], layout.markers[:, :1])
+        return layout
 
     def draw_collision(self, frame):
         """Show the cell the marker is currently colliding with"""
         if self.rows == 0:
             return
-        for center in self.centers:
+        for center in self.snapshot.centers:
             # get which cell the center is in
-            cell = self.get_cell_of_marker_center(center)
+            cell = self.get_cell_of_marker_center(center, frame)
 
-    def get_cell_of_marker_center(self, center, reversed_cols=False):
+    def get_cell_of_marker_center(self, center, frame, reversed_cols=False):
         """Detect which cell the marker is in, see: https://stackoverflow.com/a/37705365"""
         
         h, w, _ = frame.shape
@@ -235,7 +315,13 @@ class Player:
         self.is_paused = True
         self.timer = None
         self.active_cells = []
-        pass
+        self.lookahead = Lookahead(self.cells_to_notes, depth=LOOKAHEAD_COLUMNS)
+        self.queue_ahead = False # the synth can take the chord of the next beat in advance (see: SynthWorker)
+        self.queued = None # (column, beat time) of the next beat, once its chord was handed to the synth (maybe empty)
+        self.corrected = 0
+        # prepare() runs on the main thread (new snapshot) and on the scheduler thread (beat), the lookahead, `queued`
+        # and the counters are only touched while holding this lock (reentrant: play_cells calls prepare)
+        self.lock = threading.RLock()
 
     def draw_timeline(self, frame):
         if lego.marker_size == 0:
@@ -248,11 +334,7 @@ class Player:
         
         h, w, _ = frame.shape
 
-        if self.x >= w: # reset the timeline and loop the player
-            # print("out of frame", self.x, w)
-            self.x = 0 # reset
-            self.column = 0
-
+        # the timeline gets looped in advance_timeline()
         cv2.line(frame, (self.x, 0), (self.x, h), color=self.color, thickness=2)
 
         # uncomment if check every frame
@@ -262,34 +344,41 @@ class Player:
         """Checks the current column for markers.
            Do this every frame, or only once per timer call
         """
-        self.active_cells = []
-        for i, center in enumerate(coord.centers):
-            x, y = center
-
-            cell_min = lego.width_px * self.column
-            cell_max = cell_min + lego.width_px
-            
-            # check if there is a marker center that aligns with column the timeline is currently at
-            if x >= cell_min and x <= cell_max:
-                cell = coord.get_cell_of_marker_center(center, reversed_cols=True)
-
-                try:
-                    id = coord.ids[i] # IndexError: index 2 is out of bounds for axis 0 with size 2
-                except IndexError: 
-                    return 
+        with self.lock:
+            self.play_column()
+
+    def play_column(self):
+        board = coord.snapshot # one consistent state of the board for the whole beat
+        # the notes of the column the timeline is currently at, built in advance (see: prepare)
+        notes = self.lookahead.take(board, self.column)
+        if self.queued != (self.column, self.timer.time): # not handed to the synth already (e.g. the first beat)
+            synth.play_simultaneous_notes(notes, board.frame_time, self.timer.time)
+        mark_startup("first beat")
+        if len(notes):
+            mark_startup("first note")
+        if state_server is not None:
+            state_server.publish_beat(self.column, self.x, scheduler.now())
                 
-                #print("marker @", f"row:{cell.row}, col:{cell.col}")
-                self.active_cells.append((id, cell))
-                newSoundEvent.clear()
-                newSoundEvent.set()
-        
-        notes = []
-        for id, cell in self.active_cells:
-            notes.append(self.position_to_note(cell,id[0]))
-        player.active_cells = []
-        synth.play_simultaneous_notes(notes)
-                
-        self.advance_timeline() # comment if check every frame
+        self.advance_timeline(board) # comment if check every frame
+        self.prepare(board) # the timeline moved on, one more column comes into the lookahead
+        if self.queue_ahead:
+            # hand the next chord to the synth now, it plays it on the next beat without waiting for this thread.
+            # an empty chord queues nothing, but prepare() can still add notes to it until it is due (see: replace)
+            at = self.timer.next_time
+            synth.play_simultaneous_notes(self.lookahead.take(board, self.column), board.frame_time, at)
+            self.queued = (self.column, at)
+
+    def prepare(self, board:BoardSnapshot):
+        """Builds the notes of the next columns from a new snapshot, and corrects the queued chord if its column changed"""
+        if board.cell_width == 0:
+            return
+        columns = math.ceil(board.frame_size[1] / board.cell_width)
+        with self.lock:
+            changed = self.lookahead.refresh(board, self.column, columns)
+            if self.queued is not None and self.queued[0] in changed:
+                column, at = self.queued
+                if synth.replace(at, self.lookahead.take(board, column), board.frame_time):
+                    self.corrected += 1
     
     def position_to_note(self,cell, id):
         y_index = cell.col
@@ -300,22 +389,35 @@ class Player:
         volume = NOTE_VOLUME # 80
         return Note(length, note, instrument, volume)
 
+    def cells_to_notes(self, cells):
+        """position_to_note for all cells (MARKER_CELL_DTYPE) at once, returns a NOTE_DTYPE batch"""
+        return cells_to_notes(cells, REFERENCE_NOTE, NOTE_DURATION_IN_SEC)
 
-    def advance_timeline(self):
-        """Gets called by a repeating threaded timer to advance the timeline (see: Looper-Class)"""
+
+    def advance_timeline(self, board:BoardSnapshot=None):
+        """Gets called by the scheduler on every beat to advance the timeline (see: Player.start_timer)"""
+        if board is None:
+            board = coord.snapshot
         self.column += 1
-        self.x += lego.width_px 
+        self.x += board.cell_width 
+        if self.x >= board.frame_size[1]: # reset the timeline and loop the player
+            self.x = 0
+            self.column = 0
         # print("player @ col", self.column)
     
     def start_timer(self):
-        self.timer = Looper(NOTE_DURATION_IN_SEC, self.play_cells) # comment if check every frame
-        # self.timer = Looper(NOTE_DURATION_IN_SEC, self.advance_timeline) # uncomment if check every frame
-        self.timer.start()
+        self.queue_ahead = LOOKAHEAD_COLUMNS > 0 and hasattr(synth, "replace")
+        self.timer = scheduler.every(NOTE_DURATION_IN_SEC, self.play_cells) # comment if check every frame
+        # self.timer = scheduler.every(NOTE_DURATION_IN_SEC, self.advance_timeline) # uncomment if check every frame
         self.is_paused = False
 
     def stop_timer(self):
         if self.timer:
             self.timer.cancel()
+        with self.lock:
+            if self.queued is not None:
+                synth.replace(self.queued[1], ()) # don't play the next beat after all
+                self.queued = None
 
     def on_pause(self):
         if self.timer == None:
@@ -332,13 +434,21 @@ class Player:
                 self.is_paused = True
 
 
-class Looper(threading.Timer):
-    """A threaded looping timer, based on: https://stackoverflow.com/a/48741004"""
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+def cells_to_notes(cells, reference_note, duration, volume=NOTE_VOLUME):
+    """The notes of the cells (MARKER_CELL_DTYPE) as a NOTE_DTYPE batch (see: Player.position_to_note)"""
+    cells = cells[cells["id"] < len(ID_TO_PROGRAM)]
+    cells = cells[ID_TO_PROGRAM[cells["id"]] >= 0] # markers without an instrument
+    notes = np.empty(len(cells), dtype=NOTE_DTYPE)
+    notes["pitch"] = reference_note + cells["col"]
+    notes["instrument"] = ID_TO_PROGRAM[cells["id"]]
+    notes["velocity"] = volume
+    notes["duration"] = duration
+    return notes
+
 
 class Cell:
+    __slots__ = ("row", "col")
+
     def __init__(self, row, col):
         self.row = row  
         self.col = col
@@ -348,66 +458,237 @@ class Cell:
 lego = Lego()
 coord = Coordinator()
 player = Player()
-synth = SoundGenerator(SAMPLING_RATE)
-newSoundEvent = threading.Event()
-
-# ----- LOOP ----- #
-
-cap = cv2.VideoCapture(cam_id, cv2.CAP_DSHOW)
-cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-
-def synth_thread():
-
+profiler = Profiler()
+scheduler = None # one thread for the beat and all note-offs, started below (or by render_midi.py)
+synth = None # plays the notes, a SynthWorker (or a SoundGenerator in render_midi.py)
+state_server = None # StateServer, if started with --serve
+startup_times = {} # milestone -> seconds since LAUNCH_TIME, the first time it was reached (see: --dry-run)
+
+def mark_startup(name):
+    if name not in startup_times:
+        startup_times[name] = time.perf_counter() - LAUNCH_TIME
+
+def camera_settings(cap):
+    """The settings of a camera to save with the calibration, None for recorded sources"""
+    return cap.settings() if isinstance(cap, CameraSource) else None
+
+def make_note_detector():
+    """Every detection worker gets its own detector"""
+    if ADAPTIVE_DETECTION:
+        if DETECTION_MODE == "roi":
+            # it would tune for the size of every crop and count the markers per crop instead of per frame
+            raise ValueError("ADAPTIVE_DETECTION only works with DETECTION_MODE = \"full\"")
+        # with the pyramid it sees the downscaled image, so it needs the marker size in that image too
+        detector = AdaptiveDetector(aruco_dict_notes, lambda: int(lego.marker_size * min(PYRAMID_SCALE, 1)))
+    else:
+        detector = aruco.ArucoDetector(aruco_dict_notes, aruco.DetectorParameters())
+    if PYRAMID_SCALE < 1:
+        detector = PyramidDetector(detector, scale=PYRAMID_SCALE)
+    if DETECTION_MODE == "roi":
+        detect = RoiDetector(detector, full_scan_every=FULL_SCAN_EVERY).detect
+    else:
+        def detect(gray):
+            corners, ids, rejected = detector.detectMarkers(gray)
+            return corners, ids
+    if GOVERNOR_MAX_EVERY > 1:
+        return FrameGovernor(detect, max_every=GOVERNOR_MAX_EVERY).detect
+    return detect
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Plays the lego markers under the camera as notes.")
+    parser.add_argument("source", nargs="?", default="0", help="camera id, video file or directory of images (default: 0)")
+    parser.add_argument("bpm", nargs="?", type=float, help="tempo, one column per beat (default: 120)")
+    parser.add_argument("reference_note", nargs="?", type=int, default=REFERENCE_NOTE,
+                        help=f"midi note of the lowest row (default: {REFERENCE_NOTE})")
+    parser.add_argument("-f", "-F", "-flip", "--flip", dest="flip", action="store_true", help="turn the image upside down")
+    parser.add_argument("--headless", action="store_true",
+                        help="no window, no midi output, process the frames as fast as possible and report the frame rate")
+    parser.add_argument("--synth", action="store_true", help="play the notes with the built-in synth (needs pyaudio)")
+    parser.add_argument("--serve", action="store_true", help="stream the board and the beats over udp (see: state_server.py)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adaptive detector parameters and fewer detections while the board is still")
+    parser.add_argument("--calibration", metavar="FILE", help="load the calibration from here, 'c' saves it there")
+    parser.add_argument("--layout", metavar="FILE", help="start playing this board, until the camera sees markers")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="no window, quit after the first note and print how long the startup took")
+    argv = sys.argv[1:] if argv is None else list(argv)
+    argv = ["--flip" if arg == "flip" else arg for arg in argv] # old spelling
+    return parser.parse_intermixed_args(argv) # the flag may come between the positional arguments
+
+
+def make_sink(args):
+    """Opens the output of the notes (opening a midi port can take a while, so it runs next to opening the camera)"""
+    if args.headless:
+        sink = NullSink()
+    elif args.synth:
+        from synthesizer import AudioSink # needs pyaudio
+        sink = AudioSink(SAMPLING_RATE, profiler)
+    else:
+        sink = PortSink() # default midi port
+    mark_startup("sink")
+    return sink
+
+
+def open_camera(source):
+    cap = open_source(source)
+    mark_startup("source")
+    return cap
+
+
+def start_state_server():
+    from state_server import StateServer
+    server = StateServer()
+    server.start()
+    print("streaming the board on udp port", server.port)
+    return server
+
+
+def main(argv=None):
+    global NOTE_DURATION_IN_SEC, REFERENCE_NOTE, ADAPTIVE_DETECTION, GOVERNOR_MAX_EVERY, SHOW_PROFILE
+    global scheduler, synth, state_server
+    args = parse_args(argv)
+    if args.bpm is not None:
+        NOTE_DURATION_IN_SEC = 60 / args.bpm
+    REFERENCE_NOTE = args.reference_note
+    if args.adaptive:
+        ADAPTIVE_DETECTION = True
+        GOVERNOR_MAX_EVERY = 8
+    no_window = args.headless or args.dry_run
+
+    # the camera, the midi port and the state server start in parallel, the detectors start with the pipeline's workers
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as startup:
+        cap_future = startup.submit(open_camera, args.source)
+        sink_future = startup.submit(make_sink, args)
+        server_future = startup.submit(start_state_server) if args.serve else None
+
+        scheduler = Scheduler()
+        scheduler.start()
+        calibration = None
+        if args.calibration is not None and os.path.exists(args.calibration):
+            calibration = Calibration.load(args.calibration)
+            coord.apply_calibration(calibration)
+            print("loaded calibration from", args.calibration)
+        layout = coord.load_layout(args.layout) if args.layout is not None else None
+        hold_layout = layout is not None # keep playing the loaded layout until the camera sees markers
+
+        sink = sink_future.result()
+        synth = SynthWorker(SoundGenerator(SAMPLING_RATE, scheduler, sink, profiler))
+        synth.start()
+        state_server = server_future.result() if server_future is not None else None
+        cap = cap_future.result()
+    if isinstance(cap, CameraSource):
+        for saved in (calibration, layout):
+            if saved is not None:
+                cap.apply_settings(saved.camera)
+
+    # ----- LOOP ----- #
+
+    tracker = MarkerTracker(max_missed=TRACK_MAX_MISSED, smoothing=TRACK_SMOOTHING)
+    pipeline = Pipeline(cap, make_note_detector, workers=DETECTION_WORKERS, flip=args.flip, profiler=profiler)
+    pipeline.start()
+    start_time = time.perf_counter()
+    if no_window:
+        coord.has_started = True # nobody is there to press enter
+    last_seq = 0
     while True:
-        if end_synth_thread_flag:
+        if args.dry_run and ("first note" in startup_times or time.perf_counter() - start_time > DRY_RUN_TIMEOUT):
             break
-        newSoundEvent.wait()
-
-end_synth_thread_flag = False
-synth_thread = threading.Thread(target=synth_thread)
-synth_thread.start()
-while True:
-    # Capture a frame from the webcam
-    ret, frame = cap.read()
-
-    if not ret:
-        print("No frame")
-        continue
-    if flip_image:
-        frame = cv2.flip(frame, -1)
-
-    # Convert the frame to grayscale
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    
-    # Detect ArUco markers in the frame
-    corners, ids, rejected = detector_notes.detectMarkers(gray)
-
-    # Check if markers for the borders are detected
-    if ids is not None:
-        # aruco.drawDetectedMarkers(frame, corners, ids)
-        lego.set_lego_size(corners, frame) 
-        coord.get_marker_center(corners, frame)
-        coord.ids = ids
-        coord.draw_collision(frame)
-
-    coord.draw_grid(frame)
-    player.draw_timeline(frame)
-
-    # Display the frame
-    cv2.imshow('frame', frame)
-
-    # Wait for a key press and check if it's the 'q' key
-    key = cv2.waitKey(1)
-    if key == 27 or key == 113: # esc or q
-        player.stop_timer()
-        break
-    elif key == 32: # space
-        player.on_pause()
-    elif key == 13: # enter
-        coord.has_started = True
-
-
-# Release the video capture object and close all windows
-cap.release()
-end_synth_thread_flag = True
-cv2.destroyAllWindows()
+        # Get the newest frame from the capture thread
+        packet = pipeline.next_frame()
+
+        if packet is None:
+            if pipeline.done():
+                break # recorded input is over
+            print("No frame")
+            continue
+        mark_startup("first frame")
+        # draw on a copy, the detection workers might still read the captured frame
+        frame = packet.frame.copy()
+
+        # Use the newest markers the detection workers have found
+        result = pipeline.latest_result()
+
+        # Check if markers for the borders are detected
+        if result is not None and result.seq != last_seq: # only once per detection result
+            mark_startup("first detection")
+            if result.ids is not None:
+                # aruco.drawDetectedMarkers(frame, result.corners, result.ids)
+                lego.set_lego_size(result.corners, frame) 
+            with profiler.stage("track"):
+                centers, ids = tracker.update(result.corners, result.ids)
+            if hold_layout and len(ids) == 0:
+                pass # keep playing the loaded layout until the camera sees markers
+            else:
+                hold_layout = False
+                coord.set_markers(centers, ids, result.timestamp)
+            if state_server is not None:
+                state_server.publish_snapshot(coord.snapshot)
+            last_seq = result.seq
+
+        with profiler.stage("draw_collision"):
+            coord.draw_markers(frame)
+            coord.draw_collision(frame)
+
+        with profiler.stage("draw"):
+            coord.draw_grid(frame)
+            player.draw_timeline(frame)
+
+        if no_window:
+            continue
+
+        if SHOW_PROFILE:
+            profiler.draw_overlay(frame)
+
+        # Display the frame
+        with profiler.stage("imshow"):
+            cv2.imshow('frame', frame)
+
+        # Wait for a key press and check if it's the 'q' key
+        with profiler.stage("waitKey"):
+            key = cv2.waitKey(1)
+        if key == 27 or key == 113: # esc or q
+            player.stop_timer()
+            break
+        elif key == 32: # space
+            player.on_pause()
+        elif key == 13: # enter
+            coord.has_started = True
+        elif key == 115: # s
+            coord.save_layout("layout.npz", camera_settings(cap))
+        elif key == 99: # c
+            coord.save_calibration(args.calibration or "calibration.npz", camera_settings(cap))
+        elif key == 112: # p
+            SHOW_PROFILE = not SHOW_PROFILE
+
+
+    # Stop the pipeline, release the video capture object and close all windows
+    player.stop_timer()
+    pipeline.stop()
+    if args.dry_run:
+        print("startup (seconds since launch):")
+        for name, seconds in sorted(startup_times.items(), key=lambda item: item[1]):
+            print(f"  {name:<16}{seconds:7.3f}")
+        if "first note" not in startup_times:
+            print(f"  no note within {DRY_RUN_TIMEOUT:.0f}s (are there markers on the board?)")
+    else:
+        elapsed = time.perf_counter() - start_time
+        detected = profiler.count("detectMarkers")
+        print(f"detected {detected} frames in {elapsed:.1f}s ({detected / elapsed:.1f} frames/sec)")
+        profiler.print_report()
+        if PROFILE_FILE:
+            profiler.dump(PROFILE_FILE)
+    print("timing:", scheduler.stats(), f"dropped chords: {synth.dropped}")
+    print("lookahead:", player.lookahead.stats(), f"corrected chords: {player.corrected}")
+    synth.stop()
+    if state_server is not None:
+        state_server.stop()
+    if args.synth:
+        print("note cache:", sink.synth.cache.stats())
+    scheduler.stop()
+    cap.release()
+    cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    main()
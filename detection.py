@@ -1,8 +1,26 @@
+import os
+import sys
+import time
 import cv2
 import numpy as np
 import cv2.aruco as aruco
-
-cam_id = 0
+from frame_source import open_source, CameraSource
+from calibration import Calibration
+from profiling import Profiler
+from detectors import PyramidDetector
+from geometry import sort_points_polar
+
+# usage: py detection.py [CAMERA ID | VIDEO | IMAGE DIRECTORY] [--headless] [--calibration FILE]
+headless = "--headless" in sys.argv # no window, process the frames as fast as possible and report the frame rate
+args = [a for a in sys.argv[1:] if a != "--headless"]
+calibration_file = None # start with the homography saved there, 'c' saves it there
+if "--calibration" in args:
+    i = args.index("--calibration")
+    calibration_file = args[i + 1]
+    del args[i:i + 2]
+cam_id = args[0] if args else 0
+PYRAMID_SCALE = 1.0 # < 1: detect on a downscaled frame and refine the corners in full resolution
+RECTIFY_MODE = "gray" # transform the board to fit the frame: "image" (whole frame), "gray" (only the detection input), "points" (only the marker corners) or None
 
 aruco_dict_border = aruco.getPredefinedDictionary(aruco.DICT_6X6_100)
 aruco_dict_notes = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
@@ -10,28 +28,14 @@ aruco_dict_notes = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
 aruco_params = aruco.DetectorParameters()
 detector_border = aruco.ArucoDetector(aruco_dict_border,aruco_params)
 detector_notes = aruco.ArucoDetector(aruco_dict_notes, aruco_params)
+if PYRAMID_SCALE < 1:
+    detector_border = PyramidDetector(detector_border, scale=PYRAMID_SCALE)
+    detector_notes = PyramidDetector(detector_notes, scale=PYRAMID_SCALE)
 
 
 def sort_points():
     global points
-    origin = np.mean(points,0)
-    polar = np.apply_along_axis(lambda a : to_polar(a, origin), 1, points)
-    polar = polar[polar[:, 1].argsort()] # https://stackoverflow.com/a/2828121
-    points = np.apply_along_axis(lambda a : to_cartesian(a, origin), 1, polar)
-
-def to_polar(point:np.array, origin:np.array=np.array((0,0))) -> np.array:
-    p_relative = point-origin
-    theta = np.arctan2(p_relative[1], p_relative[0])
-    r = np.sqrt(p_relative[0]**2 + p_relative[1]**2)
-    return np.array((r, theta))
-
-def to_cartesian(point:np.array, origin:np.array):
-    r = point[0]
-    theta = point[1]
-    x = r * np.cos(theta)
-    y = r * np.sin(theta)
-    p_relative = np.array((x,y))
-    return p_relative + origin
+    points = sort_points_polar(points)
 
 
 class Playfield():
@@ -40,83 +44,168 @@ class Playfield():
     fit the video frame
     """
 
-    def __init__(self):
+    def __init__(self, tolerance=2.0):
         self.has_transformed = False
         self.marker_ids = [0, 1, 2, 3]
         self.prev_transform = []
+        self.tolerance = tolerance # pixels the border markers may move before the transform gets recomputed
+        self.size = None
+        self.matrix = None
+        self.maps = None # lookup tables for cv2.remap, see: update_maps()
 
-    def transform_game_field(self, ids:list[list[int]], corners, frame):
+    def update_transform(self, ids:list[list[int]], corners, size):
         """
-        Uses the outer corners of the markers on the board
-        to transform the board to fit the webcam.
+        Uses the outer corners of the markers on the board to compute the transform,
+        `size` is the (height, width) of the frame.
         Keeps the the orientation until all expected markers have been detected.
-        Returns the transformed image.
+        Only recomputes the transform if the markers moved more than `tolerance`.
         """
-        
-        marker_ids = self.marker_ids # expected markers
-        ids = ids.flatten()
-        ids.sort() 
-
-        if len(ids) == 4 and (marker_ids == ids).all():
-            c = corners
-            # get the top-left corner of each marker for comparison
-            m_0 = c[ids[0]][0][0] # x/y coordinates of top-left corner
-            m_1 = c[ids[1]][0][0]
-            m_2 = c[ids[2]][0][0]
-            m_3 = c[ids[3]][0][0]
-
-            self.prev_transform = np.float32(np.array([m_0, m_1, m_3, m_2]))
+        size = tuple(size[:2])
+        if ids is not None:
+            ids = ids.flatten()
+            order = ids.argsort() # corners are in the order of detection, not sorted by id
+
+            if len(ids) == 4 and (self.marker_ids == ids[order]).all():
+                c = [corners[i] for i in order]
+                # get the top-left corner of each marker for comparison
+                m_0 = c[0][0][0] # x/y coordinates of top-left corner
+                m_1 = c[1][0][0]
+                m_2 = c[2][0][0]
+                m_3 = c[3][0][0]
+                points = np.float32(np.array([m_0, m_1, m_3, m_2]))
+
+                moved = len(self.prev_transform) == 0 or np.abs(points - self.prev_transform).max() > self.tolerance
+                if moved:
+                    self.prev_transform = points
+                    self.matrix = None
 
         # keep the transformation if not all markers have been reliably found
-        if len(self.prev_transform) > 0:
-            old_points = self.prev_transform
-            height, width, c = frame.shape
+        if len(self.prev_transform) > 0 and (self.matrix is None or size != self.size):
+            height, width = size
             new_points = np.float32(np.array([ [0, 0], [width, 0], [width, height], [0, height] ]))
+            self.matrix = cv2.getPerspectiveTransform(self.prev_transform, new_points)
+            self.size = size
+            self.update_maps()
+            self.has_transformed = True
+
+    def load_matrix(self, matrix, size):
+        """Starts with a saved homography, until the border markers are detected somewhere else"""
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.size = tuple(size[:2])
+        self.update_maps()
+        self.has_transformed = True
+
+    def update_maps(self):
+        """Precomputes where every pixel of the transformed image comes from, so each frame only needs a cv2.remap.
+           With an identity camera and no distortion the rectification is just the homography.
+        """
+        height, width = self.size
+        identity = np.eye(3)
+        self.maps = cv2.initUndistortRectifyMap(identity, None, self.matrix, identity, (width, height), cv2.CV_16SC2)
+
+    def warp(self, image):
+        """Transforms a (BGR or grayscale) image, warping only the gray image is a lot cheaper"""
+        if self.maps is None:
+            return image
+        return cv2.remap(image, self.maps[0], self.maps[1], cv2.INTER_LINEAR)
+
+    def warp_corners(self, corners):
+        """Transforms only the marker coordinates instead of whole images"""
+        if self.matrix is None or len(corners) == 0:
+            return corners
+        points = np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2)
+        points = cv2.perspectiveTransform(points, self.matrix)
+        return tuple(points.reshape(-1, 1, 4, 2))
 
-            matrix = cv2.getPerspectiveTransform(old_points, new_points )
-            frame = cv2.warpPerspective(frame, matrix, (width, height))
-
-        return frame
+    def transform_game_field(self, ids:list[list[int]], corners, frame):
+        """
+        Uses the outer corners of the markers on the board
+        to transform the board to fit the webcam.
+        Returns the transformed image.
+        """
+        self.update_transform(ids, corners, frame.shape)
+        return self.warp(frame)
 
 # Init
 playfield = Playfield()
 
-cap = cv2.VideoCapture(cam_id, cv2.CAP_DSHOW)
-cap.set(cv2.CAP_PROP_AUTOFOCUS, 0) # turn the autofocus off
+cap = open_source(cam_id)
+if calibration_file is not None and os.path.exists(calibration_file):
+    calibration = Calibration.load(calibration_file)
+    if calibration.homography is not None:
+        playfield.load_matrix(calibration.homography, calibration.frame_size)
+    if isinstance(cap, CameraSource):
+        cap.apply_settings(calibration.camera)
+profiler = Profiler()
+frame_count = 0
+start_time = time.perf_counter()
+
+def timed(stage, since):
+    """Records the time since `since` for the stage and returns the current time"""
+    now = time.perf_counter()
+    profiler.record(stage, now - since)
+    return now
+
 while True:
     # Capture a frame from the webcam
+    t = time.perf_counter()
     ret, frame = cap.read()
 
     if not ret:
+        if cap.finished:
+            break
         print("No frame")
         continue
+    frame_count += 1
+    t = timed("capture", t)
     # Convert the frame to grayscale
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    t = timed("cvtColor", t)
     # Detect ArUco markers in the frame
     #corners, ids, rejectedImgPoints = aruco.detectMarkers(gray, aruco_dict, parameters=aruco_params)
     border_corners, border_ids, border_rejectedImgPoints = detector_border.detectMarkers(gray)
 
-    corners, ids, rejected = detector_notes.detectMarkers(gray)
-
     # Check if markers for the borders are detected
     if border_ids is not None:
         # Draw lines along the sides of the marker
         aruco.drawDetectedMarkers(frame, border_corners, border_ids)
+    t = timed("detect border", t)
 
-        #frame = playfield.transform_game_field(border_ids, border_corners, frame)
+    if RECTIFY_MODE is not None:
+        playfield.update_transform(border_ids, border_corners, gray.shape)
+    if RECTIFY_MODE == "image":
+        frame = playfield.warp(frame)
+        gray = playfield.warp(gray)
+    elif RECTIFY_MODE == "gray":
+        gray = playfield.warp(gray)
+    t = timed("rectify", t)
 
-        # border_markers = border_corners[np.where(border_ids in [0,1,2,3])]
-        # print(border_ids)
+    corners, ids, rejected = detector_notes.detectMarkers(gray)
+
+    if RECTIFY_MODE == "points":
+        corners = playfield.warp_corners(corners)
+    t = timed("detect notes", t)
 
+    if headless:
+        continue
 
     # Display the frame
     cv2.imshow('frame', frame)
 
     # Wait for a key press and check if it's the 'q' key
-    if cv2.waitKey(1) & 0xFF == ord('q'):
+    key = cv2.waitKey(1) & 0xFF
+    if key == ord('q'):
         break
+    elif key == ord('c') and playfield.matrix is not None: # save the homography (sizes are kept from coordinator.py)
+        camera = cap.settings() if isinstance(cap, CameraSource) else None
+        old = Calibration.load(calibration_file) if calibration_file and os.path.exists(calibration_file) else Calibration()
+        Calibration(old.marker_size, old.cell_size, playfield.size, playfield.matrix, camera).save(calibration_file or "calibration.npz")
+        print("saved calibration to", calibration_file or "calibration.npz")
+
+elapsed = time.perf_counter() - start_time
+print(f"processed {frame_count} frames in {elapsed:.1f}s ({frame_count / elapsed:.1f} frames/sec)")
+profiler.print_report()
 
 # Release the video capture object and close all windows
 cap.release()
 cv2.destroyAllWindows()
-
@@ -0,0 +1,267 @@
+import math
+from collections import deque
+import numpy as np
+import cv2
+
+
+def marker_bounds(corners):
+    """Bounding boxes (x0, y0, x1, y1) of all markers"""
+    points = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+    return np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+
+
+def merge_rois(rois):
+    """Merges overlapping rectangles, so no marker gets searched (and found) twice"""
+    rois = [list(r) for r in rois]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rois)):
+            for j in range(i + 1, len(rois)):
+                a, b = rois[i], rois[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rois[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rois
+
+
+class PyramidDetector:
+    """Detects markers on a downscaled image and refines the corners at full resolution.
+       Only small windows around the corners get looked at in full resolution (sub-pixel refinement).
+       Drop-in replacement for `ArucoDetector` (same `corners, ids, rejected` as `detectMarkers`).
+    """
+    def __init__(self, detector, scale=0.5):
+        self.detector = detector
+        self.scale = scale
+        # the window has to cover the error of the coarse corner (about one downscaled pixel)
+        self.window = (max(2, math.ceil(1 / scale)), ) * 2
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 0.05)
+
+    def detectMarkers(self, gray):
+        if self.scale >= 1:
+            return self.detector.detectMarkers(gray)
+
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        corners, ids, rejected = self.detector.detectMarkers(small)
+        rejected = tuple(self.to_full_resolution(r) for r in rejected)
+        if ids is None:
+            return corners, ids, rejected
+
+        # map all corners back at once: (N, 1, 4, 2) -> (N * 4, 1, 2) as cornerSubPix expects
+        points = self.to_full_resolution(np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2))
+        points = cv2.cornerSubPix(gray, points, self.window, (-1, -1), self.criteria)
+        points = points.reshape(-1, 1, 4, 2)
+        return tuple(points), ids, rejected
+
+    def to_full_resolution(self, points):
+        # pixel centers: x_small = (x + 0.5) * scale - 0.5
+        return ((points + 0.5) / self.scale - 0.5).astype(np.float32)
+
+
+class RoiDetector:
+    """Tracking mode: re-detects markers only in padded regions around the markers of the last frame.
+       Scans the full frame every `full_scan_every` frames or as soon as a marker got lost.
+       Returns `corners, ids` in the same shape as `ArucoDetector.detectMarkers`.
+    """
+    def __init__(self, detector, full_scan_every=30, padding=0.5):
+        self.detector = detector
+        self.full_scan_every = full_scan_every
+        self.padding = padding # relative to the marker size
+        self.frame_count = 0
+        self.corners = ()
+        self.ids = None
+        self.full_scans = 0
+
+    def detect(self, gray):
+        self.frame_count += 1
+        if self.ids is None or self.frame_count % self.full_scan_every == 0:
+            return self.full_scan(gray)
+
+        corners, ids = self.detect_in_rois(gray)
+        if ids is None or len(ids) < len(self.ids):
+            return self.full_scan(gray) # lost a marker (or it moved too far)
+
+        self.corners, self.ids = corners, ids
+        return corners, ids
+
+    def full_scan(self, gray):
+        self.full_scans += 1
+        corners, ids, rejected = self.detector.detectMarkers(gray)
+        self.corners, self.ids = corners, ids
+        return corners, ids
+
+    def detect_in_rois(self, gray):
+        h, w = gray.shape[:2]
+        bounds = marker_bounds(self.corners)
+        pad = (bounds[:, 2:] - bounds[:, :2]).max(axis=1, keepdims=True) * self.padding
+        rois = np.concatenate([bounds[:, :2] - pad, bounds[:, 2:] + pad], axis=1)
+        rois = np.clip(rois, 0, [w, h, w, h]).astype(int)
+
+        found_corners = []
+        found_ids = []
+        for x0, y0, x1, y1 in merge_rois(rois):
+            corners, ids, rejected = self.detector.detectMarkers(gray[y0:y1, x0:x1])
+            if ids is None:
+                continue
+            offset = np.array([x0, y0], dtype=np.float32)
+            found_corners.extend(c + offset for c in corners)
+            found_ids.append(ids)
+
+        if not found_ids:
+            return (), None
+        return tuple(found_corners), np.concatenate(found_ids)
+
+
+def odd(value):
+    value = max(3, int(value))
+    return value if value % 2 else value + 1
+
+
+class AdaptiveDetector:
+    """Detector whose parameters follow the size of the markers and how reliably they get detected.
+       Level 0 only searches for candidates of about the marker size with two threshold windows (fast),
+       level 1 allows more sizes and windows, level 2 uses the defaults. The level goes up when markers get lost
+       and down again after a window of detections without a loss.
+       `marker_size`: callable returning the marker size in pixels (0: unknown), None: measures it from the detections.
+       Drop-in replacement for `ArucoDetector` (same `corners, ids, rejected` as `detectMarkers`).
+    """
+    SMALL_MARKER = 30 # pixels, smaller markers get their corners refined
+    MAX_LEVEL = 2
+
+    def __init__(self, dictionary, marker_size=None, window=30, min_success=0.95):
+        self.dictionary = dictionary
+        self.detector = cv2.aruco.ArucoDetector(dictionary, cv2.aruco.DetectorParameters())
+        self.marker_size = marker_size
+        self.measured_size = 0
+        self.window = window
+        self.min_success = min_success
+        self.found = deque(maxlen=window) # number of markers found in the last detections
+        self.level = self.MAX_LEVEL # defaults until the marker size is known
+        self.tuned_for = None # (marker size, image size, level) the parameters were set for
+        self.level_changes = 0
+
+    def current_marker_size(self):
+        if self.marker_size is None:
+            return self.measured_size
+        return self.marker_size()
+
+    def tune(self, size, image_size):
+        """Sets the parameters for markers of `size` pixels in an image with the longer side `image_size`"""
+        params = cv2.aruco.DetectorParameters()
+        if size > 0 and self.level < self.MAX_LEVEL:
+            perimeter = 4 * size / image_size # as the detector measures it
+            module = size / 6 # one bit of a 4x4 marker with its black border
+            if self.level == 0:
+                params.adaptiveThreshWinSizeMin = odd(module)
+                params.adaptiveThreshWinSizeMax = odd(max(module, size / 2))
+                params.adaptiveThreshWinSizeStep = max(1, params.adaptiveThreshWinSizeMax - params.adaptiveThreshWinSizeMin)
+                params.minMarkerPerimeterRate = 0.6 * perimeter
+                params.maxMarkerPerimeterRate = min(4.0, 1.6 * perimeter)
+            else:
+                params.adaptiveThreshWinSizeMax = odd(max(23, size / 2))
+                params.adaptiveThreshWinSizeStep = max(1, (params.adaptiveThreshWinSizeMax - 3) // 2)
+                params.minMarkerPerimeterRate = 0.4 * perimeter
+            if size < self.SMALL_MARKER:
+                params.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+        self.detector.setDetectorParameters(params)
+        self.tuned_for = (size, image_size, self.level)
+
+    def detectMarkers(self, gray):
+        size = self.current_marker_size()
+        if size > 0 and self.level == self.MAX_LEVEL and (self.tuned_for is None or self.tuned_for[0] == 0):
+            self.level = 0 # the size just got known: start with the fast parameters
+        image_size = max(gray.shape[:2])
+        if self.tuned_for != (size, image_size, self.level):
+            self.tune(size, image_size)
+
+        corners, ids, rejected = self.detector.detectMarkers(gray)
+        if ids is not None and self.marker_size is None:
+            self.measured_size = int(np.median([cv2.arcLength(c, True) for c in corners]) / 4)
+        self.update_level(0 if ids is None else len(ids))
+        return corners, ids, rejected
+
+    def update_level(self, found):
+        self.found.append(found)
+        if len(self.found) < self.window or self.current_marker_size() == 0:
+            return
+        expected = max(self.found) # the board doesn't change much within the window
+        if expected == 0:
+            return
+        success = sum(self.found) / (expected * len(self.found))
+        if success < self.min_success and self.level < self.MAX_LEVEL:
+            self.level += 1 # losing markers: search wider
+        elif success == 1 and self.level > 0:
+            self.level -= 1 # nothing lost for a whole window: try the faster parameters
+        else:
+            return
+        self.level_changes += 1
+        self.found.clear()
+
+
+class FrameGovernor:
+    """Skips the detection while the board is stable: detects every frame while something moves,
+       every 2nd, 4th, ... up to every `max_every`th frame the longer the markers stay where they are.
+       A cheap comparison with a tiny version of the last detected frame catches motion in skipped frames,
+       so a new or moved block gets detected right away. Returns the last result for skipped frames.
+    """
+    def __init__(self, detect, max_every=8, stable_after=10, motion_threshold=4.0, marker_threshold=3.0, scale=0.125):
+        self.detect_markers = detect # gray -> corners, ids
+        self.max_every = max_every
+        self.stable_after = stable_after # detections without change until the rate gets halved
+        self.motion_threshold = motion_threshold # mean gray value difference of the tiny frames
+        self.marker_threshold = marker_threshold # pixels a marker may move and still count as stable
+        self.scale = scale
+        self.every = 1
+        self.since_detection = 0
+        self.stable = 0
+        self.last_small = None
+        self.corners = ()
+        self.ids = None
+        self.detections = 0
+        self.skips = 0
+
+    def detect(self, gray):
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        self.since_detection += 1
+        if self.since_detection < self.every and not self.moved(small):
+            self.skips += 1
+            return self.corners, self.ids
+
+        corners, ids = self.detect_markers(gray)
+        if self.same_markers(corners, ids):
+            self.stable += 1
+            if self.stable >= self.stable_after:
+                self.every = min(self.every * 2, self.max_every)
+                self.stable = 0
+        else:
+            self.every = 1
+            self.stable = 0
+        self.corners, self.ids = corners, ids
+        self.last_small = small
+        self.since_detection = 0
+        self.detections += 1
+        return corners, ids
+
+    def moved(self, small):
+        if self.last_small is None or small.shape != self.last_small.shape:
+            return True
+        return cv2.absdiff(small, self.last_small).mean() > self.motion_threshold
+
+    def same_markers(self, corners, ids):
+        if ids is None or self.ids is None:
+            return ids is None and self.ids is None
+        if len(ids) != len(self.ids):
+            return False
+        # sort both by id and position, then compare marker by marker
+        a = self.sorted_markers(self.corners, self.ids)
+        b = self.sorted_markers(corners, ids)
+        return bool(np.all(a[:, 0] == b[:, 0]) and np.abs(a[:, 1:] - b[:, 1:]).max() <= self.marker_threshold)
+
+    def sorted_markers(self, corners, ids):
+        centers = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2).mean(axis=1)
+        markers = np.column_stack([np.asarray(ids, dtype=np.float32).reshape(-1), centers])
+        return markers[np.lexsort((markers[:, 1], markers[:, 0]))]
@@ -0,0 +1,96 @@
+import os
+import sys
+import cv2
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+# camera settings that get saved with the calibration (see: calibration.py)
+CAMERA_PROPERTIES = {
+    "width": cv2.CAP_PROP_FRAME_WIDTH,
+    "height": cv2.CAP_PROP_FRAME_HEIGHT,
+    "autofocus": cv2.CAP_PROP_AUTOFOCUS,
+    "focus": cv2.CAP_PROP_FOCUS,
+    "auto_exposure": cv2.CAP_PROP_AUTO_EXPOSURE,
+    "exposure": cv2.CAP_PROP_EXPOSURE,
+    "gain": cv2.CAP_PROP_GAIN,
+}
+
+
+class CameraSource:
+    """A live camera"""
+    live = True
+
+    def __init__(self, cam_id:int):
+        backend = cv2.CAP_DSHOW if sys.platform == "win32" else cv2.CAP_ANY
+        self.cap = cv2.VideoCapture(cam_id, backend)
+        self.cap.set(cv2.CAP_PROP_AUTOFOCUS, 0) # turn the autofocus off
+        self.finished = False # a camera never runs out of frames
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
+
+    def read(self):
+        return self.cap.read()
+
+    def release(self):
+        self.cap.release()
+
+    def settings(self):
+        return {name: self.cap.get(prop) for name, prop in CAMERA_PROPERTIES.items()}
+
+    def apply_settings(self, settings):
+        """Sets the saved camera settings again (the auto modes first, so they don't override the manual values)"""
+        for name in sorted(settings, key=lambda n: not n.startswith("auto")):
+            if name in CAMERA_PROPERTIES:
+                self.cap.set(CAMERA_PROPERTIES[name], settings[name])
+
+
+class VideoFileSource:
+    """A recorded video, frames come as fast as they can be decoded"""
+    live = False
+
+    def __init__(self, path:str):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise FileNotFoundError(f"Can't open video: {path}")
+        self.finished = False
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            self.finished = True
+        return ret, frame
+
+    def release(self):
+        self.cap.release()
+
+
+class ImageDirSource:
+    """A directory of images (e.g. PNGs), read in the order of their file names"""
+    live = False
+
+    def __init__(self, path:str, fps=30):
+        self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.files:
+            raise FileNotFoundError(f"No images in: {path}")
+        self.index = 0
+        self.finished = False
+        self.fps = fps
+
+    def read(self):
+        if self.index >= len(self.files):
+            self.finished = True
+            return False, None
+        frame = cv2.imread(self.files[self.index])
+        self.index += 1
+        return frame is not None, frame
+
+    def release(self):
+        pass
+
+
+def open_source(source):
+    """Camera id (e.g. 0), video file or directory of images -> frame source with a VideoCapture-like read()"""
+    if isinstance(source, int) or str(source).isdigit():
+        return CameraSource(int(source))
+    if os.path.isdir(source):
+        return ImageDirSource(source)
+    return VideoFileSource(source)
@@ -0,0 +1,62 @@
+import numpy as np
+
+# one detected marker and the grid cell it is in
+# (as in Cell: row = index along the x-axis (time), col = index along the y-axis (pitch))
+MARKER_CELL_DTYPE = np.dtype([
+    ("id", np.int32),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("row", np.int32),
+    ("col", np.int32),
+])
+
+
+def marker_centers(corners) -> np.ndarray:
+    """Centers of all markers at once: (N, 1, 4, 2) corners -> (N, 2) integer pixel coordinates"""
+    if len(corners) == 0:
+        return np.empty((0, 2), dtype=np.int32)
+    points = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+    return points.mean(axis=1).astype(np.int32) # truncate like int()
+
+
+def marker_cells(centers, ids, cell_width:int, cell_height:int, reverse_cols:int=None) -> np.ndarray:
+    """Grid cells of all marker centers, see: https://stackoverflow.com/a/37705365
+       If `reverse_cols` is given the col index is counted backwards from it (see Coordinator.get_cell_of_marker_center).
+       Returns a structured array with MARKER_CELL_DTYPE.
+    """
+    centers = np.asarray(centers, dtype=np.int32).reshape(-1, 2)
+    ids = np.asarray(ids, dtype=np.int32).reshape(-1)
+
+    cells = np.empty(len(centers), dtype=MARKER_CELL_DTYPE)
+    cells["id"] = ids
+    cells["x"] = centers[:, 0]
+    cells["y"] = centers[:, 1]
+    cells["row"] = centers[:, 0] // cell_width
+    cells["col"] = centers[:, 1] // cell_height
+    if reverse_cols is not None:
+        cells["col"] = reverse_cols - cells["col"]
+    return cells
+
+
+def to_polar(points:np.ndarray, origin:np.ndarray=np.array((0,0))) -> np.ndarray:
+    """(N, 2) cartesian points -> (N, 2) with (r, theta) relative to `origin`"""
+    p_relative = np.asarray(points) - origin
+    theta = np.arctan2(p_relative[..., 1], p_relative[..., 0])
+    r = np.hypot(p_relative[..., 0], p_relative[..., 1])
+    return np.stack((r, theta), axis=-1)
+
+
+def to_cartesian(points:np.ndarray, origin:np.ndarray) -> np.ndarray:
+    """(N, 2) points with (r, theta) -> (N, 2) cartesian points"""
+    points = np.asarray(points)
+    r = points[..., 0]
+    theta = points[..., 1]
+    p_relative = np.stack((r * np.cos(theta), r * np.sin(theta)), axis=-1)
+    return p_relative + origin
+
+
+def sort_points_polar(points:np.ndarray) -> np.ndarray:
+    """Sorts the points by their angle around their mean, see: https://stackoverflow.com/a/2828121"""
+    points = np.asarray(points)
+    p_relative = points - points.mean(axis=0)
+    return points[np.arctan2(p_relative[:, 1], p_relative[:, 0]).argsort()]
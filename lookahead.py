@@ -0,0 +1,62 @@
+import numpy as np
+from board_state import BoardSnapshot
+
+
+class Batch:
+    __slots__ = ("version", "cells", "notes")
+
+    def __init__(self, version, cells, notes):
+        self.version = version # of the snapshot the batch was checked against
+        self.cells = cells
+        self.notes = notes
+
+
+class Lookahead:
+    """The note batches of the next `depth` columns of the timeline, built from the newest board snapshot.
+       refresh() runs whenever a snapshot gets published (on the vision side), so the beat only has to look its batch up.
+       A batch stays as it is while the cells of its column don't change, the other columns can move freely.
+    """
+    def __init__(self, build, depth):
+        self.build = build # cells of a column (MARKER_CELL_DTYPE) -> NOTE_DTYPE batch
+        self.depth = depth # columns ahead of the timeline whose notes are kept ready
+        self.batches = {} # column -> Batch, replaced as a whole (never changed), like the board snapshot
+        self.built = 0
+        self.reused = 0
+        self.missed = 0 # batches that weren't ready (or out of date) at the beat
+
+    def refresh(self, board:BoardSnapshot, column, columns) -> list:
+        """Prepares the columns from `column` on (looping at `columns`), returns the columns whose notes changed"""
+        old = self.batches
+        batches = {}
+        changed = []
+        for i in range(min(self.depth, columns)):
+            c = (column + i) % columns
+            old_batch = old.get(c)
+            batch = self.check(old_batch, board, c)
+            if old_batch is None or batch.notes is not old_batch.notes:
+                changed.append(c)
+            batches[c] = batch
+        self.batches = batches
+        return changed
+
+    def take(self, board:BoardSnapshot, column):
+        """The notes of the column, as of `board`"""
+        batch = self.batches.get(column)
+        if batch is None or batch.version != board.version:
+            self.missed += 1
+            batch = self.check(batch, board, column)
+        return batch.notes
+
+    def check(self, batch:Batch, board:BoardSnapshot, column) -> Batch:
+        """`batch` if it is still up to date, otherwise a new one"""
+        if batch is not None and batch.version == board.version:
+            return batch
+        cells = board.cells_in_column(column)
+        if batch is not None and np.array_equal(batch.cells, cells):
+            self.reused += 1
+            return Batch(board.version, batch.cells, batch.notes)
+        self.built += 1
+        return Batch(board.version, cells, self.build(cells))
+
+    def stats(self):
+        return {"built": self.built, "reused": self.reused, "missed": self.missed}
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+
+class CachedOverlay:
+    """A static layer (e.g. the grid) that gets drawn once and then pasted onto every frame.
+       `draw(layer)` draws onto an empty BGRA image, the alpha channel is the mask (draw with alpha 255).
+       The layer only gets drawn again if the key (everything it depends on) or the frame size changes.
+    """
+    def __init__(self, draw):
+        self.draw = draw
+        self.key = None
+        self.image = None
+        self.mask = None
+        self.renders = 0
+
+    def apply(self, frame, key):
+        h, w = frame.shape[:2]
+        if (key, h, w) != self.key:
+            layer = np.zeros((h, w, 4), dtype=np.uint8)
+            self.draw(layer)
+            self.image = np.ascontiguousarray(layer[..., :3])
+            self.mask = np.ascontiguousarray(layer[..., 3])
+            self.key = (key, h, w)
+            self.renders += 1
+        cv2.copyTo(self.image, self.mask, frame) # the only per frame work
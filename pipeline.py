@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import deque
+import cv2
+from profiling import Profiler
+
+
+class FramePacket:
+    """A captured frame tagged with its sequence number and capture time (perf_counter)"""
+    def __init__(self, seq, timestamp, frame):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.frame = frame
+
+
+class DetectionResult:
+    """The markers found in the frame with the sequence number `seq`"""
+    def __init__(self, seq, timestamp, corners, ids):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.corners = corners
+        self.ids = ids
+
+
+class FrameRing:
+    """A bounded ring buffer that only ever hands out the newest frame.
+       Older frames get dropped when the buffer is full or when a newer one is taken.
+       With `drop=False` (recorded input) no frame gets dropped: frames are taken in order
+       and push() waits until there is space.
+    """
+    def __init__(self, capacity=2, drop=True):
+        self.frames = deque(maxlen=capacity)
+        self.drop = drop
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def close(self):
+        """Stops waiting in push()"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def push(self, packet):
+        with self.cond:
+            if not self.drop:
+                while len(self.frames) == self.frames.maxlen and not self.closed:
+                    self.cond.wait()
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(packet)
+            self.cond.notify_all()
+
+    def take(self, timeout=None):
+        """Removes and returns the newest frame, everything older is stale and gets dropped (or the oldest with drop=False)"""
+        with self.cond:
+            if not self.frames and not self.cond.wait(timeout):
+                return None
+            if not self.frames:
+                return None
+            if not self.drop:
+                packet = self.frames.popleft()
+            else:
+                packet = self.frames.pop()
+                self.dropped += len(self.frames)
+                self.frames.clear()
+            self.cond.notify_all() # there is space again
+            return packet
+
+
+class ResultSlot:
+    """Holds the newest detection result, results of older frames that finish late are ignored"""
+    def __init__(self):
+        self.result = None
+        self.lock = threading.Lock()
+
+    def publish(self, result):
+        with self.lock:
+            if self.result is None or result.seq > self.result.seq:
+                self.result = result
+
+    def latest(self):
+        return self.result # reading a reference is atomic
+
+
+class Pipeline:
+    """Splits the main loop into a capture thread, a pool of detection workers and the render stage (caller).
+       `make_detector` gets called once per worker and has to return a function: gray -> (corners, ids)
+       Frames of recorded sources (source.live == False) don't get dropped, every frame gets detected.
+    """
+    def __init__(self, cap, make_detector, workers=2, flip=False, profiler:Profiler=None):
+        self.cap = cap
+        self.make_detector = make_detector
+        self.num_workers = workers
+        self.flip = flip
+        live = getattr(cap, "live", True)
+        self.display_ring = FrameRing(capacity=1)
+        self.detect_ring = FrameRing(capacity=2 * workers, drop=live)
+        self.results = ResultSlot()
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.running = False
+        self.capture_done = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.capture_loop, name="capture", daemon=True)]
+        for i in range(self.num_workers):
+            self.threads.append(threading.Thread(target=self.detect_loop, name=f"detect-{i}", daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        self.running = False
+        self.detect_ring.close()
+        for t in self.threads:
+            t.join(timeout=1.0)
+
+    def done(self):
+        """True once a recorded source ran out of frames and all of them have been detected"""
+        return self.capture_done and not any(t.is_alive() for t in self.threads[1:])
+
+    def capture_loop(self):
+        seq = 0
+        while self.running:
+            start = time.perf_counter()
+            ret, frame = self.cap.read()
+            if not ret:
+                if getattr(self.cap, "finished", False):
+                    break
+                print("No frame")
+                continue
+            if self.flip:
+                frame = cv2.flip(frame, -1)
+            seq += 1
+            packet = FramePacket(seq, time.perf_counter(), frame)
+            self.profiler.record("capture", packet.timestamp - start)
+            self.display_ring.push(packet)
+            self.detect_ring.push(packet)
+        self.capture_done = True
+
+    def detect_loop(self):
+        detect = self.make_detector()
+        while self.running:
+            packet = self.detect_ring.take(timeout=0.1)
+            if packet is None:
+                if self.capture_done:
+                    break
+                continue
+            with self.profiler.stage("cvtColor"):
+                gray = cv2.cvtColor(packet.frame, cv2.COLOR_BGR2GRAY)
+            with self.profiler.stage("detectMarkers"):
+                corners, ids = detect(gray)
+            self.results.publish(DetectionResult(packet.seq, packet.timestamp, corners, ids))
+
+    def next_frame(self, timeout=1.0):
+        """Returns the newest captured frame for the render stage (or None on timeout)"""
+        return self.display_ring.take(timeout)
+
+    def latest_result(self):
+        return self.results.latest()
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from collections import deque
+import cv2
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+OVERLAY_COLOR = (0, 255, 255)
+
+
+class StageTimer:
+    """Context manager that records how long the `with` block took"""
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """Keeps the last `history` durations of every stage (thread safe) for rolling percentiles.
+       usage: with profiler.stage("detect"): ...
+    """
+    def __init__(self, history=500):
+        self.history = history
+        self.samples = {} # stage -> deque of seconds
+        self.counts = {} # stage -> number of samples overall
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.history)
+                self.counts[stage] = 0
+            self.samples[stage].append(seconds)
+            self.counts[stage] += 1
+
+    def count(self, stage):
+        return self.counts.get(stage, 0)
+
+    def report(self):
+        """stage -> count, mean and p50/p95/p99 in ms (of the last `history` samples)"""
+        with self.lock:
+            samples = {stage: np.array(values) * 1000 for stage, values in self.samples.items()}
+            counts = dict(self.counts)
+        report = {}
+        for stage, ms in samples.items():
+            p = np.percentile(ms, PERCENTILES)
+            report[stage] = {"count": counts[stage], "mean_ms": float(ms.mean())}
+            report[stage].update({f"p{q}_ms": float(v) for q, v in zip(PERCENTILES, p)})
+        return report
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_report(self):
+        for stage, r in self.report().items():
+            print(f"  {stage}: mean {r['mean_ms']:.2f} ms, p50 {r['p50_ms']:.2f}, p95 {r['p95_ms']:.2f}, p99 {r['p99_ms']:.2f} ({r['count']}x)")
+
+    def draw_overlay(self, frame):
+        """Shows p50/p95/p99 of every stage in the top right corner"""
+        w = frame.shape[1]
+        for i, (stage, r) in enumerate(self.report().items()):
+            text = f"{stage}: {r['p50_ms']:.1f} / {r['p95_ms']:.1f} / {r['p99_ms']:.1f} ms"
+            cv2.putText(frame, text, (w - 330, 20 + i * 16), cv2.FONT_HERSHEY_PLAIN, 1, OVERLAY_COLOR)
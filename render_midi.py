@@ -0,0 +1,95 @@
+"""Renders a recorded video or a saved board layout into a midi file, without a camera or midi device.
+   Runs in virtual time, so it is a lot faster than real time.
+   usage: py render_midi.py INPUT OUTPUT.mid [--bpm BPM] [--reference-note NOTE] [--loops N] [--flip]
+   INPUT: a video file or a board layout (.npz or .json, press 's' in coordinator.py to save one)
+   OUTPUT: a midi file, or a wav file (.wav) rendered with the built-in synth
+"""
+import math
+import sys
+import cv2
+import coordinator
+from coordinator import lego, coord, player
+from scheduler import VirtualScheduler
+from tracking import MarkerTracker
+from sound_generation import SoundGenerator, FileSink
+from synthesizer import WavSink
+
+
+def setup(output, bpm, reference_note):
+    """Replaces the live scheduler and midi port of the coordinator"""
+    coordinator.NOTE_DURATION_IN_SEC = 60 / bpm
+    coordinator.REFERENCE_NOTE = reference_note
+    coordinator.scheduler = VirtualScheduler()
+    sink = WavSink(output, coordinator.SAMPLING_RATE) if output.endswith(".wav") else FileSink(output, bpm)
+    coordinator.synth = SoundGenerator(coordinator.SAMPLING_RATE, coordinator.scheduler, sink)
+    return coordinator.scheduler
+
+
+def render_video(path, scheduler, flip=False):
+    """Runs the video through the same steps as the main loop of coordinator.py, one frame after the other"""
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    detect = coordinator.make_note_detector()
+    tracker = MarkerTracker(max_missed=coordinator.TRACK_MAX_MISSED, smoothing=coordinator.TRACK_SMOOTHING)
+    coord.has_started = True # as if enter was pressed on the first frame
+
+    frame_count = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if flip:
+            frame = cv2.flip(frame, -1)
+        scheduler.advance(frame_count / fps)
+        frame_count += 1
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        corners, ids = detect(gray)
+        if ids is not None:
+            lego.set_lego_size(corners, frame)
+        coord.set_markers(*tracker.update(corners, ids))
+
+        coord.draw_grid(frame)
+        player.draw_timeline(frame)
+    cap.release()
+    return frame_count / fps
+
+
+def render_layout(path, scheduler, loops=1):
+    """Plays the saved board `loops` times"""
+    coord.load_layout(path)
+    player.start_timer()
+    player.start = True
+    columns = math.ceil(coord.frame_size[1] / lego.width_px) # the player loops once its x is outside the frame
+    duration = loops * columns * coordinator.NOTE_DURATION_IN_SEC
+    scheduler.advance(duration + 0.001) # play the last beat as well
+    return duration
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"--bpm": 120.0, "--reference-note": coordinator.REFERENCE_NOTE, "--loops": 1}
+    for name, default in options.items():
+        if name in args:
+            i = args.index(name)
+            options[name] = type(default)(args[i + 1])
+            del args[i:i + 2]
+    flip = "--flip" in args
+    if flip:
+        args.remove("--flip")
+    if len(args) != 2:
+        print(__doc__)
+        sys.exit(1)
+    source, output = args
+
+    scheduler = setup(output, options["--bpm"], options["--reference-note"])
+    if source.endswith((".npz", ".json")):
+        duration = render_layout(source, scheduler, options["--loops"])
+    else:
+        duration = render_video(source, scheduler, flip)
+    player.stop_timer()
+    scheduler.advance(scheduler.now() + coordinator.NOTE_DURATION_IN_SEC) # let the last notes end
+    coordinator.synth.close()
+    if output.endswith(".wav"):
+        print("note cache:", coordinator.synth.sink.synth.cache.stats())
+    print(f"rendered {duration:.1f}s into {output}")
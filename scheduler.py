@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+import numpy as np
+
+SPIN_THRESHOLD = 0.002 # seconds before a deadline the scheduler stops sleeping and spins instead (sleeping is too coarse)
+
+
+class ScheduledEvent:
+    """A callback that is due at `deadline` (time.perf_counter())"""
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RepeatingEvent:
+    """Calls `callback` at start + n * interval, so the time the callback takes doesn't add up to drift"""
+    def __init__(self, scheduler, interval, callback, start):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.callback = callback
+        self.start = start
+        self.beat = 0
+        self.time = None # deadline of the beat that is being played
+        self.cancelled = False
+        self.event = scheduler.call_at(start, self.tick)
+
+    @property
+    def next_time(self):
+        """Deadline of the next beat"""
+        return self.event.deadline
+
+    def tick(self):
+        if self.cancelled:
+            return
+        self.time = self.event.deadline
+        # schedule the next beat first, skip beats that are already over (e.g. after a hiccup)
+        now = self.scheduler.now()
+        self.beat = max(self.beat + 1, int((now - self.start) / self.interval) + 1)
+        self.event = self.scheduler.call_at(self.start + self.beat * self.interval, self.tick)
+        self.callback()
+
+    def cancel(self):
+        self.cancelled = True
+        self.event.cancel()
+
+
+class Scheduler:
+    """Runs callbacks at exact time.perf_counter() deadlines on one long-lived thread.
+       Events are kept in a heap, so many note-offs don't need a thread each.
+    """
+    def __init__(self, history=1000):
+        self.events = [] # heap of (deadline, order, event)
+        self.order = itertools.count() # keeps events with the same deadline in the order they were added
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.lateness = deque(maxlen=history) # how late (in seconds) the last events ran
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join(timeout=1.0)
+
+    def call_at(self, deadline, callback, *args):
+        event = ScheduledEvent(deadline, callback, args)
+        with self.cond:
+            heapq.heappush(self.events, (deadline, next(self.order), event))
+            self.cond.notify()
+        return event
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now() + delay, callback, *args)
+
+    def now(self):
+        return time.perf_counter()
+
+    def every(self, interval, callback, start=None):
+        """Calls `callback` every `interval` seconds, the first time at `start` (default: in one interval)"""
+        if start is None:
+            start = self.now() + interval
+        return RepeatingEvent(self, interval, callback, start)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.events or self.events[0][0] - time.perf_counter() > SPIN_THRESHOLD):
+                    timeout = self.events[0][0] - time.perf_counter() - SPIN_THRESHOLD if self.events else None
+                    self.cond.wait(timeout)
+                if not self.running:
+                    return
+                deadline, order, event = self.events[0]
+
+            while time.perf_counter() < deadline:
+                time.sleep(0) # spin for the last bit, but let other threads run
+
+            with self.cond:
+                # an earlier event might have been added while spinning
+                if not self.events or self.events[0][2] is not event:
+                    continue
+                heapq.heappop(self.events)
+
+            if event.cancelled:
+                continue
+            self.lateness.append(time.perf_counter() - deadline)
+            try:
+                event.callback(*event.args)
+            except Exception as e:
+                print("scheduled callback failed:", repr(e))
+
+    def stats(self):
+        """Lateness (mean, max) and jitter (standard deviation of the lateness) of the last events in ms"""
+        lateness = np.array(self.lateness) * 1000
+        if len(lateness) == 0:
+            return {"events": 0}
+        return {
+            "events": len(lateness),
+            "mean_lateness_ms": float(lateness.mean()),
+            "max_lateness_ms": float(lateness.max()),
+            "jitter_ms": float(lateness.std()),
+        }
+
+
+class VirtualScheduler(Scheduler):
+    """Runs the events in virtual time instead of waiting for them (for rendering faster than real time).
+       Time only moves on with advance().
+    """
+    def __init__(self, history=1000):
+        super().__init__(history)
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def advance(self, until):
+        """Runs all events up to `until` in the order they are due"""
+        while self.events and self.events[0][0] <= until:
+            deadline, order, event = heapq.heappop(self.events)
+            self.time = max(self.time, deadline)
+            if not event.cancelled:
+                event.callback(*event.args)
+        self.time = max(self.time, until)
@@ -1,9 +1,11 @@
 import numpy as np
 import threading
+import time
+from collections import deque
 import mido
+from scheduler import Scheduler, SPIN_THRESHOLD
+from profiling import Profiler
 from enum import Enum
-# import pyaudio
-# from scipy.signal import sawtooth, square
 # import seaborn as sns
 # import matplotlib.pyplot as plt
 # from pynput import keyboard
@@ -37,61 +39,310 @@ class Note():
     # pulse: pulsewidth of the signal (only applies to pulse waves.)
     # sawwidth: width of the rising portion of the triangular wave form in proportion of one cycle. 0.0 produces a sawtooth wave, 0.5 produces a symmetrical triangle wave, 1.0 a sawtooth wave (but flipped). Only for sawtooth waves.
     
+    __slots__ = ("length", "note", "instrument", "volume")
+
     def __init__(self, length:float, note:int, instrument:Instrument, volume:int):
         self.length = length
         self.note = note
         self.instrument = instrument
         self.volume = volume
 
+# a batch of notes without a Note object per note (see: Player.cells_to_notes)
+NOTE_DTYPE = np.dtype([
+    ("pitch", np.int16), # midi note
+    ("instrument", np.int16), # Instrument.value
+    ("velocity", np.uint8), # volume
+    ("duration", np.float32), # length in seconds
+])
+
+
+def note_tuples(notes:(list|np.ndarray)) -> list:
+    """(pitch, instrument value, velocity, duration) of every note, from a NOTE_DTYPE batch or Note objects"""
+    if isinstance(notes, np.ndarray):
+        return notes.tolist()
+    return [(note.note, note.instrument.value, note.volume, note.length) for note in notes]
+
 SAMPLING_RATE = 11400
 CHUNK_SIZE = 512
-NUM_TRACKS = 10 # number of sounds that can be played in parallel
-# py_audio = pyaudio.PyAudio()
+NUM_TRACKS = 10 # number of sounds that can be played in parallel (built-in synth, see synthesizer.py)
+
+DRUM_CHANNEL = 9 # general midi percussion channel
+DRUMS = [Instrument.BASS_DRUM, Instrument.SNARE] # value - 900 = key on the drum channel
+DRUM_PROGRAMS = {drum.value for drum in DRUMS}
+MELODIC_CHANNELS = [c for c in range(16) if c != DRUM_CHANNEL]
+
+class PortSink():
+    """Sends the midi messages to a live port"""
+
+    def __init__(self, name=None):
+        self.out_port = mido.open_output(name)
+
+    def send(self, messages, timestamp):
+        for msg in messages:
+            self.out_port.send(msg)
+
+    def close(self):
+        self.out_port.close()
+
+
+class NullSink():
+    """Drops all midi messages (e.g. for headless benchmarks)"""
+
+    def send(self, messages, timestamp):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink():
+    """Writes the midi messages into a standard midi file instead of playing them.
+       The messages get timed by the (scheduler) time they were sent at.
+    """
+
+    def __init__(self, path, bpm=120, ticks_per_beat=480):
+        self.path = path
+        self.file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+        self.track = mido.MidiTrack()
+        self.file.tracks.append(self.track)
+        self.tempo = mido.bpm2tempo(bpm)
+        self.track.append(mido.MetaMessage('set_tempo', tempo=self.tempo))
+        self.start = None
+        self.last_tick = 0
+
+    def send(self, messages, timestamp):
+        if self.start is None:
+            self.start = timestamp # the file starts with the first message
+        tick = round(mido.second2tick(timestamp - self.start, self.file.ticks_per_beat, self.tempo))
+        tick = max(tick, self.last_tick)
+        for msg in messages:
+            self.track.append(msg.copy(time=tick - self.last_tick)) # delta time in ticks
+            self.last_tick = tick
+
+    def close(self):
+        self.file.save(self.path)
+
 
 class SoundGenerator():
 
-    def __init__(self,sampling_rate):
-        self.out_port = mido.open_output()
+    def __init__(self,sampling_rate, scheduler:Scheduler=None, sink=None, profiler:Profiler=None, channels:list=None):
+        """`channels`: the melodic midi channels this generator may use (e.g. to share a port between boards), default all"""
+        self.profiler = profiler # measures the latency from the frame to sending the notes
+        if sink is None:
+            sink = PortSink()
+        self.sink = sink
+        self.renders_notes = hasattr(sink, "play_notes") # the built-in synth plays whole notes, it gets no midi messages
+        if scheduler is None: # note-offs get sent by the scheduler's thread
+            scheduler = Scheduler()
+            scheduler.start()
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.channels = {} # Instrument.value -> midi channel
+        self.melodic_channels = list(channels or MELODIC_CHANNELS)
+        self.programs = {} # midi channel -> program it is currently set to
+        self.sounding = {} # (channel, note) -> the chord that started it, so a later chord doesn't get cut off
+        self.chord_count = 0
+        self.bytes_sent = 0
 
-    def play_simultaneous_notes(self,notes:(list|np.ndarray)):
+    def get_channel(self, instrument:(Instrument|int)):
+        """Every instrument gets its own channel, so they don't change each other's program"""
+        program = getattr(instrument, "value", instrument)
+        if program in DRUM_PROGRAMS:
+            return DRUM_CHANNEL
+        if program not in self.channels:
+            # more instruments than channels: share them round robin
+            self.channels[program] = self.melodic_channels[len(self.channels) % len(self.melodic_channels)]
+        return self.channels[program]
+
+    def play_simultaneous_notes(self,notes:(list|np.ndarray), frame_time:float=None, at:float=None):
+        """`notes`: Note objects or a NOTE_DTYPE batch
+           `frame_time`: perf_counter time of the frame the notes were detected in (for the latency)
+           `at`: the (scheduler) time the notes are meant for, e.g. their beat (default: now), the note-offs follow from it
+        """
         if len(notes) <= 0:
             return
-        for i, note in enumerate(notes):
-            length = note.length
-            note_height = note.note
-            volume = note.volume
-            instrument = note.instrument
-            
-            if instrument in [Instrument.BASS_DRUM, Instrument.SNARE]:
-                inst = mido.Message('program_change', program=instrument.value-900)
-                self.out_port.send(inst)
-                msg = mido.Message('note_on', note=instrument.value-900, time=length, channel=9)
-                self.out_port.send(msg)
-            else:
-                self.out_port.send(mido.Message('note_off', note=note_height, velocity=volume))
-                inst = mido.Message('program_change', program=instrument.value)
-                self.out_port.send(inst)
-                msg = mido.Message('note_on', note=note_height, velocity=volume, time=length)
-                self.out_port.send(msg)
-
-                t = threading.Timer(length+ i *0.0001, lambda note_height=note_height: self.end_note(note_height, volume, instrument.value))
-                t.start()
+        timed = at is not None
+        if at is None:
+            at = self.scheduler.now()
+        if self.renders_notes:
+            self.sink.play_notes(notes, at)
+            self.record_latency(frame_time, at if timed else None)
+            return
+        with self.lock:
+            self.chord_count += 1
+            chord = self.chord_count
+            messages = []
+            ends = {} # length -> [(channel, note)]
+            for pitch, program, velocity, length in note_tuples(notes):
+                channel = self.get_channel(program)
 
-    
-    def end_note (self, note_height, velocity, program=None, timer=None):
-        if not program is None:
-            inst = mido.Message('program_change', program=program)
-            self.out_port.send(inst)
-            
-        msg = mido.Message('note_off', note=note_height, velocity=0)
-        self.out_port.send(msg)
-        return
+                if program in DRUM_PROGRAMS:
+                    messages.append(mido.Message('note_on', note=program-900, velocity=velocity, channel=channel))
+                    continue
+
+                if self.programs.get(channel) != program:
+                    messages.append(mido.Message('program_change', program=program, channel=channel))
+                    self.programs[channel] = program
+                key = (channel, pitch)
+                if key in self.sounding: # still playing from the last beat: end it before starting it again
+                    messages.append(mido.Message('note_off', note=pitch, velocity=0, channel=channel))
+                messages.append(mido.Message('note_on', note=pitch, velocity=velocity, channel=channel))
+                self.sounding[key] = chord
+                ends.setdefault(length, []).append(key)
+
+            self.send(messages, at)
+            self.record_latency(frame_time, at if timed else None)
 
+        # one note-off event per chord (and length) instead of one per note
+        for length, keys in ends.items():
+            self.scheduler.call_at(at + length, self.end_notes, keys, chord)
+
+    def record_latency(self, frame_time, at):
+        """photon_to_midi: from the frame to the notes going out, beat_lateness: how late they went out for their `at`"""
+        if self.profiler is None:
+            return
+        now = time.perf_counter()
+        if frame_time is not None:
+            self.profiler.record("photon_to_midi", now - frame_time)
+        if at is not None:
+            self.profiler.record("beat_lateness", now - at)
+
+    def end_notes(self, keys, chord):
+        with self.lock:
+            messages = []
+            for key in keys:
+                if self.sounding.get(key) != chord:
+                    continue # retriggered by a later chord, that one will end it
+                del self.sounding[key]
+                channel, note_height = key
+                messages.append(mido.Message('note_off', note=note_height, velocity=0, channel=channel))
+            self.send(messages)
+
+    def send(self, messages, timestamp=None):
+        """Sends all messages of a chord in one go"""
+        if not messages:
+            return
+        start = time.perf_counter()
+        self.sink.send(messages, self.scheduler.now() if timestamp is None else timestamp)
+        if self.profiler is not None:
+            self.profiler.record("midi_send", time.perf_counter() - start)
+        self.bytes_sent += sum(len(msg.bytes()) for msg in messages)
 
+    def all_notes_off(self):
+        """Ends the notes that are still sounding (their note-offs would otherwise be lost with the scheduler)"""
+        with self.lock:
+            messages = [mido.Message('note_off', note=note_height, velocity=0, channel=channel)
+                        for channel, note_height in self.sounding]
+            self.sounding.clear()
+            self.send(messages)
 
-            
-            
+    def close(self):
+        self.all_notes_off()
+        self.sink.close()
 
-            
 
+def frame_time_at(frame_time, at):
+    """The frame time of a chord queued ahead for `at`, moved by the time it waits on purpose,
+       so photon_to_midi measures detection and output, not the lookahead (see: SoundGenerator.record_latency)
+    """
+    if frame_time is None or at is None:
+        return frame_time
+    return frame_time + max(0.0, at - time.perf_counter())
+
+
+class SynthWorker():
+    """Plays the notes of the player on its own thread, so the beat doesn't wait for the midi output.
+       Chords wait in a bounded queue, if the output falls behind the oldest chord gets dropped (it would be late anyway).
+       A chord can be queued ahead for the time it is due (`at`), the thread then plays it at exactly that time,
+       and replace() can still correct it until then.
+       Has the same play_simultaneous_notes() as the SoundGenerator it wraps.
+    """
+
+    def __init__(self, synth:SoundGenerator, max_pending=4):
+        self.synth = synth
+        self.queue = deque(maxlen=max_pending) # (at, notes, frame_time), in the order they are due
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.dropped = 0
+        self.corrected = 0 # queued chords that got replaced before they were due
+        self.taken = None # time of the last timed chord the thread took from the queue
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="synth", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Plays the chords that are due already and ends the thread, chords queued for a later beat are dropped"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join(timeout=1.0)
+        self.synth.close()
+
+    def play_simultaneous_notes(self, notes:(list|np.ndarray), frame_time:float=None, at:float=None):
+        """`at`: perf_counter time to play the notes at (default: right away)"""
+        if len(notes) <= 0:
+            return
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1 # deque drops the oldest
+            self.queue.append((at, notes, frame_time_at(frame_time, at)))
+            self.cond.notify()
+
+    def replace(self, at, notes:(list|np.ndarray), frame_time:float=None) -> bool:
+        """Replaces the chord queued for `at` (empty `notes`: removes it). If nothing is queued for `at` (an empty
+           chord) and it is still ahead, the notes get queued for it. False if `at` was played (or taken) already.
+        """
+        with self.cond:
+            for i, (queued_at, _, _) in enumerate(self.queue):
+                if queued_at == at:
+                    if len(notes):
+                        self.queue[i] = (at, notes, frame_time_at(frame_time, at))
+                    else:
+                        del self.queue[i]
+                    self.corrected += 1
+                    self.cond.notify()
+                    return True
+            if (self.taken is not None and at <= self.taken) or at <= time.perf_counter():
+                return False # too late
+            if len(notes):
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1
+                    self.queue.popleft()
+                # keep the queue in the order the chords are due
+                i = next((i for i, (queued_at, _, _) in enumerate(self.queue) if queued_at is not None and queued_at > at),
+                         len(self.queue))
+                self.queue.insert(i, (at, notes, frame_time_at(frame_time, at)))
+                self.corrected += 1
+                self.cond.notify()
+            return True
 
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait() # sleeps until there is something to play or stop() gets called
+                if not self.queue:
+                    return
+                at, notes, frame_time = self.queue[0]
+                if at is not None:
+                    wait = at - time.perf_counter()
+                    if not self.running and wait > 0:
+                        self.queue.popleft() # queued ahead, but nobody is playing anymore
+                        continue
+                    if wait > SPIN_THRESHOLD:
+                        self.cond.wait(wait - SPIN_THRESHOLD) # a replace() or stop() wakes it up early
+                        continue # look at the (maybe corrected) chord again
+                self.queue.popleft()
+                if at is not None:
+                    self.taken = at
+            if at is not None:
+                while time.perf_counter() < at:
+                    time.sleep(0) # spin for the last bit, like the scheduler
+            try:
+                self.synth.play_simultaneous_notes(notes, frame_time, at)
+            except Exception as e:
+                print("playing a chord failed:", repr(e)) # keep the thread alive for the next beat
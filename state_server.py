@@ -0,0 +1,289 @@
+"""Streams the board (markers, grid) and the beats of coordinator.py to other processes over UDP.
+   Start coordinator.py with --serve, then any number of clients can subscribe, e.g. this loopback client:
+   usage: py state_server.py [PORT]
+"""
+import asyncio
+import socket
+import struct
+import sys
+import threading
+import time
+import numpy as np
+from board_state import BoardSnapshot
+
+STATE_PORT = 9100
+KEYFRAME_EVERY = 100 # full snapshot after this many deltas, in case a client missed its resync
+SUBSCRIBER_TIMEOUT = 10.0 # seconds without a keepalive until a subscriber gets dropped
+MAX_BUFFER = 64 * 1024 # bytes the socket may have queued before the server skips a snapshot
+
+# requests of the clients
+SUBSCRIBE = b"SUB" # (re)subscribe, always answered with a full snapshot
+KEEPALIVE = b"HI"
+UNSUBSCRIBE = b"BYE"
+
+# messages of the server: header + body, little endian
+MAGIC = b"LS"
+FULL, DELTA, BEAT = 1, 2, 3
+HEADER = struct.Struct("<2sBII") # magic, type, seq (per subscriber), version of the board
+BOARD = struct.Struct("<HHHH") # FULL: frame height, width, cell width, height, followed by the markers
+BASE = struct.Struct("<I") # DELTA: version the delta applies to, followed by the removed and the added markers
+BEAT_BODY = struct.Struct("<HHd") # BEAT: column, x of the timeline, perf_counter time of the beat
+COUNT = struct.Struct("<H") # number of markers that follow
+MARKER_DTYPE = np.dtype([("id", "<i2"), ("x", "<i2"), ("y", "<i2")])
+
+
+def marker_array(snapshot:BoardSnapshot) -> np.ndarray:
+    markers = np.empty(len(snapshot.ids), dtype=MARKER_DTYPE)
+    markers["id"] = snapshot.ids.ravel()
+    markers["x"] = snapshot.centers[:, 0]
+    markers["y"] = snapshot.centers[:, 1]
+    return markers
+
+
+def pack_markers(markers) -> bytes:
+    markers = np.asarray(markers, dtype=MARKER_DTYPE)
+    return COUNT.pack(len(markers)) + markers.tobytes()
+
+
+def unpack_markers(data, offset):
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    markers = np.frombuffer(data, dtype=MARKER_DTYPE, count=count, offset=offset)
+    return set(markers.tolist()), offset + count * MARKER_DTYPE.itemsize
+
+
+def decode(data) -> dict:
+    """One message of the server as a dict"""
+    magic, kind, seq, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a board state message")
+    message = {"type": kind, "seq": seq, "version": version}
+    offset = HEADER.size
+    if kind == FULL:
+        h, w, cell_w, cell_h = BOARD.unpack_from(data, offset)
+        message["frame_size"] = (h, w)
+        message["cell_size"] = (cell_w, cell_h)
+        message["markers"], _ = unpack_markers(data, offset + BOARD.size)
+    elif kind == DELTA:
+        message["base"], = BASE.unpack_from(data, offset)
+        message["removed"], offset = unpack_markers(data, offset + BASE.size)
+        message["added"], _ = unpack_markers(data, offset)
+    elif kind == BEAT:
+        message["column"], message["x"], message["time"] = BEAT_BODY.unpack_from(data, offset)
+    return message
+
+
+class Subscriber:
+    __slots__ = ("addr", "seq", "needs_full", "last_seen")
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.seq = 0
+        self.needs_full = True
+        self.last_seen = time.monotonic()
+
+
+class StateProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.on_request(data, addr)
+
+
+class StateServer:
+    """Sends the board snapshots and beats to all subscribers, from an asyncio loop on its own thread.
+       publish_snapshot() and publish_beat() only hand the data to that loop, so detection and the beat never wait.
+       Snapshots that arrive faster than they can be sent get coalesced to the newest one. If only some markers changed
+       the subscribers get a delta, a subscriber that missed one asks for a full snapshot again (see: StateClient).
+    """
+    def __init__(self, host="127.0.0.1", port=STATE_PORT):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.transport = None
+        self.thread = None
+        self.subscribers = {} # addr -> Subscriber
+        self.pending = None # newest snapshot that wasn't sent yet
+        self.flush_scheduled = False
+        self.sent = None # last snapshot that was sent
+        self.sent_markers = None
+        self.sent_board = None
+        self.deltas_since_full = 0
+        self.skipped = 0 # snapshots not sent because the socket was full
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name="state-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        self.transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(lambda: StateProtocol(self), local_addr=(self.host, self.port)))
+        self.port = self.transport.get_extra_info("sockname")[1] # if port 0 was given
+        ready.set()
+        self.loop.run_forever()
+        self.transport.close()
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=1.0)
+
+    # ----- called from other threads ----- #
+
+    def publish_snapshot(self, snapshot:BoardSnapshot):
+        self.pending = snapshot
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self.flush_snapshot)
+
+    def publish_beat(self, column, x, timestamp):
+        self.loop.call_soon_threadsafe(self.send_beat, column, x, timestamp)
+
+    # ----- on the loop ----- #
+
+    def on_request(self, data, addr):
+        if data == SUBSCRIBE:
+            subscriber = self.subscribers.setdefault(addr, Subscriber(addr))
+            subscriber.needs_full = True
+            subscriber.last_seen = time.monotonic()
+            if self.sent is not None:
+                self.send(subscriber, FULL, self.sent.version, self.full_body())
+        elif data == KEEPALIVE and addr in self.subscribers:
+            self.subscribers[addr].last_seen = time.monotonic()
+        elif data == UNSUBSCRIBE:
+            self.subscribers.pop(addr, None)
+
+    def full_body(self):
+        return BOARD.pack(*self.sent_board) + pack_markers(self.sent_markers)
+
+    def flush_snapshot(self):
+        self.flush_scheduled = False
+        snapshot = self.pending # the newest, older ones that came in meanwhile are skipped
+        if snapshot is None or snapshot is self.sent:
+            return
+        if self.transport.get_write_buffer_size() > MAX_BUFFER:
+            self.skipped += 1 # slow network: skip this one, everyone gets a full snapshot next time
+            for subscriber in self.subscribers.values():
+                subscriber.needs_full = True
+            return
+
+        markers = marker_array(snapshot)
+        board = (*snapshot.frame_size, snapshot.cell_width, snapshot.cell_height)
+        if board == self.sent_board and np.array_equal(markers, self.sent_markers):
+            return # nothing moved, the subscribers stay on the version they have
+        delta = None
+        if self.sent is not None and board == self.sent_board and self.deltas_since_full < KEYFRAME_EVERY:
+            old, new = set(self.sent_markers.tolist()), set(markers.tolist())
+            delta = BASE.pack(self.sent.version) + pack_markers(list(old - new)) + pack_markers(list(new - old))
+
+        self.sent, self.sent_markers, self.sent_board = snapshot, markers, board
+        full = self.full_body()
+        if delta is not None and len(delta) < len(full):
+            self.deltas_since_full += 1
+        else:
+            delta = None
+            self.deltas_since_full = 0
+
+        self.expire_subscribers()
+        for subscriber in self.subscribers.values():
+            if delta is None or subscriber.needs_full:
+                self.send(subscriber, FULL, snapshot.version, full)
+            else:
+                self.send(subscriber, DELTA, snapshot.version, delta)
+
+    def send_beat(self, column, x, timestamp):
+        body = BEAT_BODY.pack(column, x, timestamp)
+        version = self.sent.version if self.sent is not None else 0
+        for subscriber in self.subscribers.values():
+            self.send(subscriber, BEAT, version, body)
+
+    def send(self, subscriber, kind, version, body):
+        subscriber.seq += 1
+        if kind == FULL:
+            subscriber.needs_full = False
+        self.transport.sendto(HEADER.pack(MAGIC, kind, subscriber.seq, version) + body, subscriber.addr)
+
+    def expire_subscribers(self):
+        now = time.monotonic()
+        for addr in [a for a, s in self.subscribers.items() if now - s.last_seen > SUBSCRIBER_TIMEOUT]:
+            del self.subscribers[addr]
+
+
+class StateClient:
+    """Follows the board of a StateServer (blocking, e.g. for a projection or a logger)"""
+    def __init__(self, host="127.0.0.1", port=STATE_PORT, timeout=1.0):
+        self.server = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self.markers = set() # (id, x, y)
+        self.version = None
+        self.frame_size = (0, 0)
+        self.cell_size = (0, 0)
+        self.column = None
+        self.beat_time = None
+        self.seq = 0
+        self.lost = 0 # messages that never arrived
+        self.resyncs = 0
+        self.last_keepalive = 0
+
+    def subscribe(self):
+        self.sock.sendto(SUBSCRIBE, self.server)
+        self.last_keepalive = time.monotonic()
+
+    def close(self):
+        self.sock.sendto(UNSUBSCRIBE, self.server)
+        self.sock.close()
+
+    def receive(self):
+        """Waits for the next message and applies it, returns it (or None after the timeout)"""
+        if time.monotonic() - self.last_keepalive > SUBSCRIBER_TIMEOUT / 3:
+            self.sock.sendto(KEEPALIVE, self.server)
+            self.last_keepalive = time.monotonic()
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            if self.version is None:
+                self.subscribe() # the server wasn't up yet or the request got lost
+            return None
+        message = decode(data)
+        if message["seq"] > self.seq + 1:
+            self.lost += message["seq"] - self.seq - 1
+        self.seq = message["seq"]
+
+        if message["type"] == FULL:
+            self.markers = message["markers"]
+            self.frame_size = message["frame_size"]
+            self.cell_size = message["cell_size"]
+            self.version = message["version"]
+        elif message["type"] == DELTA:
+            if message["base"] != self.version:
+                self.resyncs += 1 # missed something: start over with a full snapshot
+                self.subscribe()
+            else:
+                self.markers = (self.markers - message["removed"]) | message["added"]
+                self.version = message["version"]
+        elif message["type"] == BEAT:
+            self.column = message["column"]
+            self.beat_time = message["time"]
+        return message
+
+
+if __name__ == "__main__":
+    client = StateClient(port=int(sys.argv[1]) if len(sys.argv) > 1 else STATE_PORT)
+    client.subscribe()
+    try:
+        while True:
+            message = client.receive()
+            if message is None:
+                continue
+            if message["type"] == BEAT:
+                print(f"beat: column {client.column}")
+            else:
+                print(f"board v{client.version}: {len(client.markers)} markers (lost {client.lost}, resyncs {client.resyncs})")
+    except KeyboardInterrupt:
+        client.close()
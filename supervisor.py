@@ -0,0 +1,264 @@
+"""Plays several boards at once: one detection process per camera/video, one beat for all boards.
+   usage: py supervisor.py SOURCE[@BPM] [SOURCE[@BPM] ...] [--reference-note NOTE] [--flip] [--headless]
+   SOURCE: camera id, video file or directory of images, BPM: tempo of that board (default 120)
+   --headless: no midi output, recorded sources are processed as fast as possible
+   The boards share the midi port, every board gets its own range of midi channels.
+   All beats come from one scheduler and start at the same time, so the boards stay in phase.
+"""
+import math
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import coordinator
+from board_state import BoardSnapshot, EMPTY_BOARD
+from frame_source import open_source
+from geometry import marker_cells
+from scheduler import Scheduler
+from sound_generation import SoundGenerator, NullSink, PortSink, MELODIC_CHANNELS
+from tracking import MarkerTracker
+
+FRAME_SLOTS = 4 # frames per board in shared memory: one being written, one being read, the rest queued
+DEFAULT_BPM = 120.0
+START_DELAY = 0.5 # seconds between starting the scheduler and the first beat
+mp = multiprocessing.get_context("spawn") # don't fork a process that already runs threads (and the same on every os)
+
+
+class SharedFrames:
+    """A ring of frames in shared memory, written by the supervisor and read by the detection process of the board.
+       Every slot carries the sequence number of its frame, the reader checks it again after copying the frame,
+       so it never uses a frame that got overwritten in the meantime.
+    """
+    def __init__(self, shape, slots=FRAME_SLOTS, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        frame_bytes = int(np.prod(self.shape))
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * (frame_bytes + 8))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((slots, *self.shape), dtype=np.uint8, buffer=self.shm.buf)
+        self.seqs = np.ndarray(slots, dtype=np.int64, buffer=self.shm.buf, offset=slots * frame_bytes)
+        if self.owner:
+            self.seqs[:] = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, seq, frame):
+        slot = seq % self.slots
+        self.seqs[slot] = -1 # being written
+        self.frames[slot] = frame
+        self.seqs[slot] = seq
+
+    def read(self, seq):
+        """A copy of frame `seq`, None if it got overwritten already"""
+        slot = seq % self.slots
+        if self.seqs[slot] != seq:
+            return None
+        frame = self.frames[slot].copy()
+        if self.seqs[slot] != seq:
+            return None
+        return frame
+
+    def close(self):
+        del self.frames, self.seqs # release the buffer before closing
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def detection_process(index, shm_name, shape, frame_queue, result_queue, live, flip):
+    """Detects and tracks the markers of one board (runs in its own process).
+       Gets the sequence numbers of new frames from `frame_queue`, sends the tracked markers to `result_queue`.
+    """
+    frames = SharedFrames(shape, name=shm_name)
+    detect = coordinator.make_note_detector()
+    tracker = MarkerTracker(max_missed=coordinator.TRACK_MAX_MISSED, smoothing=coordinator.TRACK_SMOOTHING)
+    lego = coordinator.lego # this process has its own copy of the coordinator
+    coordinator.coord.has_started = True
+    while True:
+        item = frame_queue.get()
+        if live: # only the newest frame matters
+            while item is not None and not frame_queue.empty():
+                item = frame_queue.get()
+        if item is None:
+            break
+        seq, timestamp = item
+        frame = frames.read(seq)
+        if frame is None:
+            continue
+        if flip:
+            frame = cv2.flip(frame, -1)
+        corners, ids = detect(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if ids is not None:
+            lego.set_lego_size(corners, frame)
+        centers, ids = tracker.update(corners, ids)
+        result_queue.put((index, seq, timestamp, centers, ids, (lego.width_px, lego.height_px)))
+    result_queue.put((index, None, None, None, None, None)) # done
+    frames.close()
+
+
+class Board:
+    """One board of the supervisor: its source, detection process, snapshot and beat"""
+    def __init__(self, index, source, bpm, channels, reference_note, scheduler, sink, flip=False):
+        self.index = index
+        self.name = source
+        self.cap = open_source(source)
+        ret, frame = self.cap.read()
+        if not ret:
+            raise RuntimeError(f"No frame from {source}")
+        self.first_frame = frame
+        self.frames = SharedFrames(frame.shape)
+        self.frame_queue = mp.Queue(maxsize=FRAME_SLOTS - 2)
+        self.interval = 60 / bpm
+        self.channels = channels
+        self.reference_note = reference_note
+        self.scheduler = scheduler
+        self.synth = SoundGenerator(coordinator.SAMPLING_RATE, scheduler, sink, channels=channels)
+        self.flip = flip
+        self.snapshot = EMPTY_BOARD
+        self.timer = None
+        self.process = None
+        self.capture_thread = None
+        self.running = False
+        self.done = False
+        self.detected = 0
+        self.skipped = 0 # frames the detection didn't get to (live) or that got overwritten before it could read them
+
+    def start(self, result_queue):
+        self.running = True
+        self.process = mp.Process(target=detection_process, name=f"board-{self.index}", daemon=True,
+                                  args=(self.index, self.frames.name, self.first_frame.shape, self.frame_queue,
+                                        result_queue, self.cap.live, self.flip))
+        self.process.start()
+        self.capture_thread = threading.Thread(target=self.capture_loop, name=f"capture-{self.index}", daemon=True)
+        self.capture_thread.start()
+
+    def capture_loop(self):
+        seq, frame = 0, self.first_frame
+        while self.running:
+            self.frames.write(seq, frame)
+            if self.cap.live:
+                try:
+                    self.frame_queue.put_nowait((seq, time.perf_counter()))
+                except queue.Full:
+                    pass # the detection is behind, it will take a newer frame
+            else:
+                self.frame_queue.put((seq, time.perf_counter())) # recorded: wait for the detection
+            seq += 1
+            ret, frame = self.cap.read()
+            if not ret:
+                if self.cap.finished:
+                    break
+                continue
+        self.frame_queue.put(None)
+
+    def set_markers(self, seq, timestamp, centers, ids, cell_size):
+        """Publishes the markers of a detection result as a new snapshot (see: Coordinator.set_markers)"""
+        if seq is None:
+            self.done = True
+            return
+        self.detected += 1
+        self.skipped = seq + 1 - self.detected
+        cell_width, cell_height = cell_size
+        h, w = self.first_frame.shape[:2]
+        cells = ()
+        if cell_width != 0:
+            cells = marker_cells(centers, ids, cell_width, cell_height, reverse_cols=w // cell_width)
+        self.snapshot = BoardSnapshot(centers, ids, cells, cell_width, cell_height, (h, w), timestamp,
+                                      self.snapshot.version + 1)
+
+    def start_beat(self, start):
+        self.timer = self.scheduler.every(self.interval, self.beat, start)
+
+    def beat(self):
+        board = self.snapshot
+        if board.cell_width == 0:
+            return # no marker seen yet, the size of the grid is unknown
+        # the column follows from the number of the beat, so all boards stay locked to the same start
+        columns = math.ceil(board.frame_size[1] / board.cell_width)
+        column = (self.timer.beat - 1) % columns
+        notes = coordinator.cells_to_notes(board.cells_in_column(column), self.reference_note, self.interval)
+        self.synth.play_simultaneous_notes(notes, board.frame_time)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+        self.synth.all_notes_off() # the sink is shared, it gets closed after all boards stopped
+        self.running = False
+        if self.capture_thread:
+            self.capture_thread.join(timeout=1.0)
+        if self.process:
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.cap.release()
+        self.frames.close()
+
+
+def channel_ranges(count):
+    """Splits the melodic midi channels into `count` ranges"""
+    size = len(MELODIC_CHANNELS) // count
+    if size == 0:
+        raise ValueError(f"{count} boards, but only {len(MELODIC_CHANNELS)} midi channels")
+    return [MELODIC_CHANNELS[i * size:(i + 1) * size] for i in range(count)]
+
+
+def parse_source(spec):
+    source, _, bpm = spec.partition("@")
+    return source, float(bpm) if bpm else DEFAULT_BPM
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    reference_note = coordinator.REFERENCE_NOTE
+    if "--reference-note" in args:
+        i = args.index("--reference-note")
+        reference_note = int(args[i + 1])
+        del args[i:i + 2]
+    flip = "--flip" in args
+    headless = "--headless" in args
+    specs = [a for a in args if a not in ("--flip", "--headless")]
+    if not specs:
+        print(__doc__)
+        sys.exit(1)
+
+    scheduler = Scheduler()
+    scheduler.start()
+    sink = NullSink() if headless else PortSink() # shared by all boards, only used by the scheduler thread
+    result_queue = mp.Queue()
+    boards = [Board(i, source, bpm, channels, reference_note, scheduler, sink, flip)
+              for i, ((source, bpm), channels) in enumerate(zip(map(parse_source, specs), channel_ranges(len(specs))))]
+    for board in boards:
+        print(f"board {board.index}: {board.name}, {60 / board.interval:.0f} bpm, midi channels {board.channels}")
+        board.start(result_queue)
+    start = scheduler.now() + START_DELAY
+    for board in boards:
+        board.start_beat(start)
+
+    start_time = time.perf_counter()
+    try:
+        while not all(board.done for board in boards):
+            try:
+                index, *result = result_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            boards[index].set_markers(*result)
+    except KeyboardInterrupt:
+        pass
+
+    elapsed = time.perf_counter() - start_time
+    for board in boards:
+        board.stop()
+        print(f"board {board.index}: detected {board.detected} frames ({board.detected / elapsed:.1f} frames/sec), "
+              f"{board.synth.chord_count} chords, {board.skipped} frames skipped")
+    print("timing:", scheduler.stats())
+    scheduler.stop()
+    sink.close()
@@ -0,0 +1,236 @@
+import threading
+import time
+import wave
+from collections import OrderedDict
+import numpy as np
+from sound_generation import Instrument, note_tuples, SAMPLING_RATE, CHUNK_SIZE, NUM_TRACKS
+from profiling import Profiler
+try:
+    import pyaudio # only needed to play the sound live
+except ImportError:
+    pyaudio = None
+
+TABLE_SIZE = 2048 # samples of one period of a wavetable
+ATTACK = 0.005 # seconds
+RELEASE = 0.08 # seconds
+MASTER_GAIN = 0.3 # so a few voices at full volume don't clip
+CACHE_BYTES = 16 * 1024 * 1024 # memory budget for rendered notes
+
+# harmonic amplitudes of one period, decay: seconds until a held note fell to ~37% (None: holds)
+SAW = tuple(1 / k for k in range(1, 9))
+SQUARE = tuple(1 / k if k % 2 else 0 for k in range(1, 9))
+VOICES = {
+    Instrument.PIANO: ((1, .5, .3, .2, .1), 0.8),
+    Instrument.DRUM: ((1,), 0.15),
+    Instrument.DULCIMER: ((1, .6, .4, .3, .1), 0.6),
+    Instrument.STRINGS: (SAW, None),
+    Instrument.BASS: ((1, .4, .1), 1.0),
+    Instrument.HAMMOND: ((1, 1, .5, 0, .3, 0, 0, .2), None),
+    Instrument.XYLO: ((1, 0, 0, .3), 0.25),
+    Instrument.VIOLIN: (SAW, None),
+    Instrument.SQUARE: (SQUARE, None),
+    Instrument.SAW: (SAW, None),
+    Instrument.GOBLIN: ((1, .7, 0, .5, 0, .3), None),
+    Instrument.SAX: ((1, .8, .6, .3, .2), None),
+    Instrument.WOODBLOCK: ((1, 0, .5), 0.05),
+    Instrument.BASS_DRUM: ((1,), 0.2),
+    Instrument.SNARE: (None, 0.1), # None: noise
+}
+DRUM_PITCH = {Instrument.BASS_DRUM: 55.0, Instrument.SNARE: 200.0} # Hz, drums don't follow the note
+
+
+def make_wavetable(harmonics, size=TABLE_SIZE, seed=0):
+    """One period of the sum of the harmonics (or white noise), normalised to [-1, 1]"""
+    if harmonics is None:
+        table = np.random.default_rng(seed).uniform(-1, 1, size)
+    else:
+        phase = np.arange(size) * 2 * np.pi / size
+        table = sum(a * np.sin(k * phase) for k, a in enumerate(harmonics, start=1))
+    return (table / np.abs(table).max()).astype(np.float32)
+
+
+def midi_to_frequency(note):
+    return 440.0 * 2 ** ((note - 69) / 12)
+
+
+class SampleCache():
+    """LRU cache of rendered notes: (note, instrument, volume, length) -> samples.
+       The board repeats on every loop, so after the first loop the notes only get copied into the mix.
+       Evicts the least recently used notes once the buffers need more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.buffers = OrderedDict() # oldest first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, render):
+        """Returns the cached buffer of `key` or renders it with `render()`"""
+        buffer = self.buffers.get(key)
+        if buffer is not None:
+            self.hits += 1
+            self.buffers.move_to_end(key)
+            return buffer
+        self.misses += 1
+        buffer = render()
+        buffer.flags.writeable = False # shared by every voice that plays it
+        if buffer.nbytes <= self.max_bytes:
+            self.buffers[key] = buffer
+            self.bytes += buffer.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.buffers.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return buffer
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.buffers),
+            "bytes": self.bytes,
+        }
+
+
+class Synthesizer():
+    """Software synth that plays whole notes without a midi device.
+       Every note gets rendered in one go with numpy from the wavetable of its instrument (oscillator, attack/release
+       and decay for all its samples at once) and is kept in the cache, so a note that repeats only gets mixed.
+       Up to `voices` notes play at the same time, they get mixed into blocks of `chunk_size` samples.
+    """
+
+    def __init__(self, sampling_rate=SAMPLING_RATE, chunk_size=CHUNK_SIZE, voices=NUM_TRACKS, profiler:Profiler=None,
+                 cache:SampleCache=None):
+        self.sampling_rate = sampling_rate
+        self.chunk_size = chunk_size
+        self.profiler = profiler # measures the time per block ("synth_render")
+        self.cache = cache or SampleCache()
+        self.samples = OrderedDict() # (instrument, note) -> [buffer, position] of the notes that are playing
+        self.max_samples = voices
+        self.instruments = list(VOICES)
+        self.tables = np.stack([make_wavetable(VOICES[i][0]) for i in self.instruments]) # instrument index -> wavetable
+        self.decays = np.array([self.decay_per_sample(VOICES[i][1]) for i in self.instruments])
+
+    @property
+    def playing(self):
+        """True while a note can still be heard"""
+        return bool(self.samples)
+
+    def decay_per_sample(self, seconds):
+        return 1.0 if seconds is None else np.exp(-1 / (seconds * self.sampling_rate))
+
+    def render_note(self, instrument:Instrument, note:int, length:float, volume:int):
+        """Renders one note completely: attack, `length` seconds and the release"""
+        index = self.instruments.index(instrument)
+        frequency = DRUM_PITCH.get(instrument) or midi_to_frequency(note)
+        step = frequency * TABLE_SIZE / self.sampling_rate
+        hold = int(length * self.sampling_rate)
+        release = RELEASE * self.sampling_rate
+        n = np.arange(hold + int(release))
+        samples = self.tables[index][(n * step).astype(np.int64) % TABLE_SIZE]
+        env = np.minimum(np.minimum(1, (n + 1) / (ATTACK * self.sampling_rate)), np.clip(1 - (n - hold + 1) / release, 0, 1))
+        gain = volume / 127 * self.decays[index] ** n
+        audible = np.flatnonzero(gain >= 1e-4)
+        end = audible[-1] + 1 if len(audible) else 0 # drums are a lot shorter than the note
+        return (samples[:end] * env[:end] * gain[:end] * MASTER_GAIN).astype(np.float32)
+
+    def play_notes(self, notes):
+        """Starts whole notes (Note objects or a NOTE_DTYPE batch), they end by themselves"""
+        for note in note_tuples(notes):
+            pitch, program, velocity, length = note
+            buffer = self.cache.get(note, lambda: self.render_note(Instrument(program), pitch, length, velocity))
+            key = (program, pitch)
+            self.samples.pop(key, None) # retrigger
+            self.samples[key] = [buffer, 0]
+            if len(self.samples) > self.max_samples:
+                self.samples.popitem(last=False) # replace the oldest
+
+    def mix_samples(self, block):
+        for key, (buffer, position) in list(self.samples.items()):
+            piece = buffer[position:position + len(block)]
+            block[:len(piece)] += piece
+            if position + len(block) >= len(buffer):
+                del self.samples[key]
+            else:
+                self.samples[key][1] = position + len(block)
+
+    def render(self, frames=None):
+        """Mixes the next `frames` samples of all notes, returns them as float32 in [-1, 1]"""
+        frames = frames or self.chunk_size
+        start = time.perf_counter()
+        block = np.zeros(frames, dtype=np.float32)
+        if self.samples:
+            self.mix_samples(block)
+        if self.profiler is not None:
+            self.profiler.record("synth_render", time.perf_counter() - start)
+        return np.clip(block, -1, 1)
+
+
+def to_pcm16(block):
+    return (block * 32767).astype(np.int16).tobytes()
+
+
+class WavSink():
+    """Renders the notes into a wav file, timed by the (scheduler) time they are meant for"""
+
+    def __init__(self, path, sampling_rate=SAMPLING_RATE, profiler:Profiler=None):
+        self.synth = Synthesizer(sampling_rate, profiler=profiler)
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(1)
+        self.file.setsampwidth(2)
+        self.file.setframerate(sampling_rate)
+        self.start = None
+        self.frames = 0 # samples written so far
+
+    def render_until(self, frame):
+        while self.frames < frame:
+            block = self.synth.render(min(self.synth.chunk_size, frame - self.frames))
+            self.file.writeframes(to_pcm16(block))
+            self.frames += len(block)
+
+    def play_notes(self, notes, timestamp):
+        if self.start is None:
+            self.start = timestamp # the file starts with the first notes
+        self.render_until(round((timestamp - self.start) * self.synth.sampling_rate))
+        self.synth.play_notes(notes)
+
+    def close(self):
+        while self.synth.playing: # let the last notes play to their end
+            self.render_until(self.frames + self.synth.chunk_size)
+        self.file.close()
+
+
+class AudioSink():
+    """Plays the notes on the default sound device (needs pyaudio).
+       The device pulls the blocks from its own thread, notes start at the start of the next block,
+       so the latency is at most one block (CHUNK_SIZE / sampling rate).
+    """
+
+    def __init__(self, sampling_rate=SAMPLING_RATE, profiler:Profiler=None):
+        if pyaudio is None:
+            raise ImportError("the built-in synth needs pyaudio to play sound, install it or render into a wav file")
+        self.synth = Synthesizer(sampling_rate, profiler=profiler)
+        self.lock = threading.Lock()
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16, channels=1, rate=sampling_rate, output=True,
+                                      frames_per_buffer=self.synth.chunk_size, stream_callback=self.callback)
+
+    def callback(self, in_data, frame_count, time_info, status):
+        with self.lock:
+            block = self.synth.render(frame_count)
+        return to_pcm16(block), pyaudio.paContinue
+
+    def play_notes(self, notes, timestamp):
+        with self.lock:
+            self.synth.play_notes(notes)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
@@ -0,0 +1,92 @@
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+# same dimensions as the Lego class in coordinator.py (with padding)
+LEGO_WIDTH_MM = 20
+LEGO_HEIGHT_MM = 32
+MARKER_MM = 16
+BORDER_MM = 1 # white border around the markers
+
+# ground truth of one marker on the synthetic board
+TRUTH_DTYPE = np.dtype([
+    ("id", np.int32),
+    ("x_idx", np.int32), # cell index along the x-axis (time)
+    ("y_idx", np.int32), # cell index along the y-axis (pitch)
+])
+
+
+class SyntheticBoard:
+    """A generated frame and where the markers are in it"""
+    def __init__(self, frame, truth, marker_px, cell_size):
+        self.frame = frame
+        self.truth = truth
+        self.marker_px = marker_px
+        self.cell_size = cell_size # (width, height) in pixels
+
+
+def cell_size(marker_px):
+    mm_in_px = marker_px / MARKER_MM
+    return int(LEGO_WIDTH_MM * mm_in_px), int(LEGO_HEIGHT_MM * mm_in_px)
+
+
+def generate_board(resolution=(1280, 720), marker_count=10, marker_px=48, ids=(0, 1, 2, 3),
+                   blur=0, noise=0.0, warp=0.0, border_markers=True, seed=0):
+    """Draws `marker_count` note markers (DICT_4X4_100) into random, distinct cells of the grid.
+       blur: kernel size of a gaussian blur, noise: standard deviation of gaussian noise (0-255),
+       warp: how far (relative to the frame size) the corners get moved for a perspective warp,
+       border_markers: put the DICT_6X6_100 board markers (ids 0-3) into the corners.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = resolution
+    cell_w, cell_h = cell_size(marker_px)
+    cols, rows = w // cell_w, h // cell_h
+    notes_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
+    border_dict = aruco.getPredefinedDictionary(aruco.DICT_6X6_100)
+
+    frame = np.full((h, w), 255, dtype=np.uint8)
+    border_px = int(marker_px * BORDER_MM / MARKER_MM)
+    if border_markers:
+        size = marker_px
+        for i, (x, y) in enumerate([(0, 0), (w - size, 0), (0, h - size), (w - size, h - size)]):
+            frame[y:y + size, x:x + size] = aruco.generateImageMarker(border_dict, i, size)
+
+    # keep the corner cells free for the border markers
+    free = [(x, y) for x in range(cols) for y in range(rows)
+            if not (border_markers and x in (0, cols - 1) and y in (0, rows - 1))]
+    marker_count = min(marker_count, len(free))
+    cells = rng.choice(len(free), size=marker_count, replace=False)
+
+    truth = np.empty(marker_count, dtype=TRUTH_DTYPE)
+    corners = np.empty((marker_count, 4, 2), dtype=np.float32) # of the markers (without their border)
+    for i, cell in enumerate(cells):
+        x_idx, y_idx = free[cell]
+        marker_id = int(rng.choice(ids))
+        marker = aruco.generateImageMarker(notes_dict, marker_id, marker_px)
+        marker = cv2.copyMakeBorder(marker, border_px, border_px, border_px, border_px, cv2.BORDER_CONSTANT, value=255)
+        size = marker.shape[0]
+        x = x_idx * cell_w + (cell_w - size) // 2
+        y = y_idx * cell_h + (cell_h - size) // 2
+        frame[y:y + size, x:x + size] = marker
+        truth[i] = (marker_id, x_idx, y_idx)
+        x0, y0, x1, y1 = x + border_px, y + border_px, x + size - border_px, y + size - border_px
+        corners[i] = [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+    if warp > 0:
+        src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        dst = np.float32(src + rng.uniform(-warp, warp, size=(4, 2)) * [w, h])
+        homography = cv2.getPerspectiveTransform(src, dst)
+        frame = cv2.warpPerspective(frame, homography, (w, h), borderValue=255)
+        # the markers moved with the frame: their cell is where their center ended up, markers pushed out are gone
+        corners = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), homography).reshape(-1, 4, 2)
+        inside = np.all((corners >= 0) & (corners < [w, h]), axis=(1, 2))
+        centers = corners.mean(axis=1)
+        truth["x_idx"] = (centers[:, 0] // cell_w).astype(np.int32)
+        truth["y_idx"] = (centers[:, 1] // cell_h).astype(np.int32)
+        truth = truth[inside]
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (blur | 1, blur | 1), 0)
+    if noise > 0:
+        frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+
+    return SyntheticBoard(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR), truth, marker_px, (cell_w, cell_h))
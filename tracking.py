@@ -0,0 +1,65 @@
+import numpy as np
+from geometry import marker_centers
+
+
+class MarkerTracker:
+    """Follows the markers across frames, so a marker that isn't detected for a few frames doesn't vanish.
+       Detections get matched to tracks with the same id by their distance (nearest first),
+       the positions get smoothed and a track is kept alive for `max_missed` detections without it.
+    """
+    def __init__(self, max_missed=5, max_distance=50, smoothing=0.5):
+        self.max_missed = max_missed
+        self.max_distance = max_distance # pixels a marker may move between two detections
+        self.smoothing = smoothing # 0: only the newest position, towards 1: smoother but slower
+        self.ids = np.empty(0, dtype=np.int32)
+        self.centers = np.empty((0, 2), dtype=np.float32)
+        self.missed = np.empty(0, dtype=np.int32)
+
+    def update(self, corners, ids):
+        """Feeds one detection result (`ids` may be None) and returns the tracked `centers, ids`
+           in the shapes of Coordinator.centers and Coordinator.ids
+        """
+        if ids is None:
+            new_centers = np.empty((0, 2), dtype=np.float32)
+            new_ids = np.empty(0, dtype=np.int32)
+        else:
+            new_centers = marker_centers(corners).astype(np.float32)
+            new_ids = np.asarray(ids, dtype=np.int32).reshape(-1)
+
+        matched_tracks, matched_detections = self.match(new_centers, new_ids)
+
+        # matched: smooth the position
+        s = self.smoothing
+        self.centers[matched_tracks] = s * self.centers[matched_tracks] + (1 - s) * new_centers[matched_detections]
+        self.missed += 1
+        self.missed[matched_tracks] = 0
+
+        # unmatched tracks: drop them after too many misses, unmatched detections: new tracks
+        alive = self.missed <= self.max_missed
+        new = np.ones(len(new_ids), dtype=bool)
+        new[matched_detections] = False
+        self.ids = np.concatenate([self.ids[alive], new_ids[new]])
+        self.centers = np.concatenate([self.centers[alive], new_centers[new]])
+        self.missed = np.concatenate([self.missed[alive], np.zeros(new.sum(), dtype=np.int32)])
+
+        return self.centers.astype(np.int32), self.ids.reshape(-1, 1).copy()
+
+    def match(self, centers, ids):
+        """Greedy nearest neighbour matching of tracks and detections with the same id"""
+        if len(self.ids) == 0 or len(ids) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        distances = np.linalg.norm(self.centers[:, None, :] - centers[None, :, :], axis=2)
+        distances[self.ids[:, None] != ids[None, :]] = np.inf
+        distances[distances > self.max_distance] = np.inf
+
+        tracks, detections = {}, set() # track -> detection
+        for flat in np.argsort(distances, axis=None):
+            t, d = np.unravel_index(flat, distances.shape)
+            if distances[t, d] == np.inf:
+                break # sorted, only impossible pairs left
+            if t in tracks or d in detections:
+                continue
+            tracks[t] = d
+            detections.add(d)
+        return np.array(list(tracks.keys()), dtype=int), np.array(list(tracks.values()), dtype=int)